@@ -1,13 +1,23 @@
-import os, re, json, time, secrets
+import os, re, io, csv, html, gzip, json, zlib, base64, itertools, math, multiprocessing, pickle, time, random, hashlib, secrets, select, socket, tempfile, threading, unicodedata, queue, atexit
+import click
 import psycopg2
-from datetime import timedelta
+import psycopg2.pool
+import psycopg2.extras
+from psycopg2 import extensions as pg_extensions
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import quote
 from functools import wraps
-from flask import Flask, jsonify, request, send_from_directory, session, g
+from flask import Flask, Response, jsonify, request, send_file, send_from_directory, session, g
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 import PyPDF2
 from PyPDF2 import PdfReader
+import pdf_extract
 import openai
 from openai import OpenAI
 from io import BytesIO
@@ -16,6 +26,52 @@ import pgvector.psycopg2
 client = OpenAI()
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+OPENAI_MAX_RETRIES = int(os.environ.get('ATAS_OPENAI_MAX_RETRIES', 6))
+# 'openai' (EMBEDDING_MODEL over the API) or 'local' (LOCAL_EMBEDDING_MODEL on this host's CPU, no external calls)
+EMBEDDING_PROVIDER = os.environ.get('ATAS_EMBEDDING_PROVIDER', 'openai').lower()
+EMBEDDING_MODEL = os.environ.get('ATAS_EMBEDDING_MODEL', 'text-embedding-ada-002')
+LOCAL_EMBEDDING_MODEL = os.environ.get('ATAS_LOCAL_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.environ.get('ATAS_LOCAL_EMBEDDING_BATCH_SIZE', 32))
+LOCAL_EMBEDDING_THREADS = int(os.environ.get('ATAS_LOCAL_EMBEDDING_THREADS', 2))  # torch intra-op threads per worker
+LOCAL_EMBEDDING_DEVICE = os.environ.get('ATAS_LOCAL_EMBEDDING_DEVICE', 'cpu')
+# Per-request packing for embeddings.create (the API allows 2048 inputs / 300k tokens)
+EMBEDDING_BATCH_SIZE = int(os.environ.get('ATAS_EMBEDDING_BATCH_SIZE', 256))
+EMBEDDING_MAX_BATCH_TOKENS = int(os.environ.get('ATAS_EMBEDDING_MAX_BATCH_TOKENS', 250000))
+# Re-embedding (`flask reembed`): chunks per checkpointed batch, and the share of the
+# embedding budget it may use so live ingestion and search keep theirs
+REEMBED_BATCH_SIZE = int(os.environ.get('ATAS_REEMBED_BATCH_SIZE', 500))
+REEMBED_TOKENS_PER_MINUTE = int(os.environ.get('ATAS_REEMBED_TPM', 500000))
+REEMBED_REQUESTS_PER_MINUTE = int(os.environ.get('ATAS_REEMBED_RPM', 200))
+# How long the cutover waits for a table lock before backing off and retrying
+REEMBED_LOCK_TIMEOUT = os.environ.get('ATAS_REEMBED_LOCK_TIMEOUT', '5s')
+# Search query embedding cache (per-worker LRU, optionally backed by a shared Postgres table)
+EMBEDDING_CACHE_SIZE = int(os.environ.get('ATAS_EMBEDDING_CACHE_SIZE', 1000))
+EMBEDDING_CACHE_TTL = int(os.environ.get('ATAS_EMBEDDING_CACHE_TTL', 7 * 24 * 3600))
+EMBEDDING_CACHE_PERSISTENT = os.environ.get('ATAS_EMBEDDING_CACHE_PERSISTENT', 'true').lower() == 'true'
+# Smart search result cache; entries are invalidated by bumping the 'corpus' version
+SEARCH_CACHE_SIZE = int(os.environ.get('ATAS_SEARCH_CACHE_SIZE', 2000))
+SEARCH_CACHE_TTL = int(os.environ.get('ATAS_SEARCH_CACHE_TTL', 3600))
+# How stale another worker's view of a cache version may be, in seconds
+CACHE_VERSION_CHECK_INTERVAL = float(os.environ.get('ATAS_CACHE_VERSION_CHECK_INTERVAL', 2))
+REFERENCE_CACHE_TTL = int(os.environ.get('ATAS_REFERENCE_CACHE_TTL', 600))
+# How long an exact listing total (audit trail, news, events) is reused
+LISTING_COUNT_CACHE_TTL = int(os.environ.get('ATAS_LISTING_COUNT_CACHE_TTL', 60))
+# Chatbot: an FAQ must share at least this many words with the question to be returned
+FAQ_MIN_MATCHED_TERMS = int(os.environ.get('ATAS_FAQ_MIN_MATCHED_TERMS', 2))
+# Rate limits for chat completions, shared by all threads of a worker process
+OPENAI_REQUESTS_PER_MINUTE = int(os.environ.get('ATAS_OPENAI_RPM', 500))
+OPENAI_TOKENS_PER_MINUTE = int(os.environ.get('ATAS_OPENAI_TPM', 160000))
+# Document summarization (map over chunks, then reduce)
+SUMMARY_MODEL = os.environ.get('ATAS_SUMMARY_MODEL', 'gpt-3.5-turbo')
+SUMMARY_CONCURRENCY = int(os.environ.get('ATAS_SUMMARY_CONCURRENCY', 4))
+SUMMARY_CHUNK_WORDS = int(os.environ.get('ATAS_SUMMARY_CHUNK_WORDS', 1200))
+CHUNK_MAX_TOKENS = int(os.environ.get('ATAS_CHUNK_MAX_TOKENS', 400))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('ATAS_CHUNK_OVERLAP_TOKENS', 50))
+CHUNK_MIN_SECTION_TOKENS = int(os.environ.get('ATAS_CHUNK_MIN_SECTION_TOKENS', 100))
+TOKENIZER_ENCODING = os.environ.get('ATAS_TOKENIZER_ENCODING', 'cl100k_base')  # tokenizer of the OpenAI embedding models
+NORMALIZER_WORDLIST = os.environ.get('ATAS_NORMALIZER_WORDLIST', '/usr/share/dict/words')  # one word per line; '' disables
+SUMMARY_MAX_CHUNKS = int(os.environ.get('ATAS_SUMMARY_MAX_CHUNKS', 0))
+SUMMARY_REDUCE_BUDGET_TOKENS = int(os.environ.get('ATAS_SUMMARY_REDUCE_BUDGET_TOKENS', 3000))
 
 # --- DATABASE CONNECTION CONFIGURATION ---
 DB_CONFIG = {
@@ -25,7 +81,62 @@ DB_CONFIG = {
     "host": os.environ.get('ATAS_DB_HOST'),
     "port": os.environ.get('ATAS_DB_PORT')
 }
+# Each gunicorn worker keeps its own pool, so total server connections are
+# roughly (workers x ATAS_DB_POOL_SIZE).
+DB_POOL_SIZE = int(os.environ.get('ATAS_DB_POOL_SIZE', 5))
+DB_POOL_TIMEOUT = float(os.environ.get('ATAS_DB_POOL_TIMEOUT', 10))
+# Connections idle for longer than this are pinged with SELECT 1 on checkout
+DB_POOL_CHECK_AFTER = float(os.environ.get('ATAS_DB_POOL_CHECK_AFTER', 30))
+
+# Audit trail writer: 'async' batches rows on a background thread, 'sync' writes in the request
+AUDIT_MODE = os.environ.get('ATAS_AUDIT_MODE', 'async')
+AUDIT_QUEUE_SIZE = int(os.environ.get('ATAS_AUDIT_QUEUE_SIZE', 10000))
+AUDIT_BATCH_SIZE = int(os.environ.get('ATAS_AUDIT_BATCH_SIZE', 200))
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('ATAS_AUDIT_FLUSH_INTERVAL', 1.0))
+AUDIT_EXPORT_FETCH_SIZE = int(os.environ.get('ATAS_AUDIT_EXPORT_FETCH_SIZE', 2000))
+AUDIT_PARTITION_MONTHS_AHEAD = int(os.environ.get('ATAS_AUDIT_PARTITION_MONTHS_AHEAD', 3))
+AUDIT_PARTITION_CHECK_INTERVAL = float(os.environ.get('ATAS_AUDIT_PARTITION_CHECK_INTERVAL', 3600))
+AUDIT_RETENTION_MONTHS = int(os.environ.get('ATAS_AUDIT_RETENTION_MONTHS', 24))
+AUDIT_ARCHIVE_DIR = os.environ.get('ATAS_AUDIT_ARCHIVE_DIR', '/app/audit_archive')
 UPLOAD_FOLDER = '/app/uploads'
+# '' streams downloads from Python; 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd) hands them to the proxy
+DOWNLOAD_OFFLOAD = os.environ.get('ATAS_DOWNLOAD_OFFLOAD', '').lower()
+DOWNLOAD_ACCEL_PREFIX = os.environ.get('ATAS_DOWNLOAD_ACCEL_PREFIX', '/protected-uploads/')
+# Default ANN search knobs (0 = leave the server default); overridable per request
+HNSW_EF_SEARCH = int(os.environ.get('ATAS_HNSW_EF_SEARCH', 0)) or None
+IVFFLAT_PROBES = int(os.environ.get('ATAS_IVFFLAT_PROBES', 0)) or None
+# Filtered searches: larger HNSW candidate list, and optionally pgvector >= 0.8
+# iterative index scans ('relaxed_order' or 'strict_order'; empty to disable)
+FILTERED_HNSW_EF_SEARCH = int(os.environ.get('ATAS_FILTERED_HNSW_EF_SEARCH', 200))
+HNSW_ITERATIVE_SCAN = os.environ.get('ATAS_HNSW_ITERATIVE_SCAN', '')
+# How the ANN index stores chunk vectors: 'vector' (float32), 'halfvec' (float16, pgvector >= 0.7)
+# or 'binary' (1 bit per dimension). Compact indexes return a shortlist that is re-ranked
+# on the full-precision embedding column; build the matching index with build-vector-index.
+VECTOR_STORAGE = os.environ.get('ATAS_VECTOR_STORAGE', 'vector').lower()
+# Shortlist size for re-ranking, as a multiple of the rows wanted (0 = the storage mode's default)
+VECTOR_RERANK_FACTOR = int(os.environ.get('ATAS_VECTOR_RERANK_FACTOR', 0)) or None
+# Roles allowed to include archived documents in search results
+ARCHIVE_VIEWER_ROLES = ('IT Administrator', 'Super Administrator')
+# Smart search retrieval: 'hybrid' fuses vector and full-text ranks (RRF), 'vector' is vector-only
+SEARCH_MODE = os.environ.get('ATAS_SEARCH_MODE', 'hybrid')
+SEARCH_RESULTS_K = int(os.environ.get('ATAS_SEARCH_RESULTS_K', 3))
+HYBRID_CANDIDATES = int(os.environ.get('ATAS_HYBRID_CANDIDATES', 40))
+HYBRID_RRF_K = int(os.environ.get('ATAS_HYBRID_RRF_K', 60))
+HYBRID_VECTOR_WEIGHT = float(os.environ.get('ATAS_HYBRID_VECTOR_WEIGHT', 1.0))
+HYBRID_KEYWORD_WEIGHT = float(os.environ.get('ATAS_HYBRID_KEYWORD_WEIGHT', 1.0))
+HYBRID_MAX_CHUNKS_PER_DOCUMENT = int(os.environ.get('ATAS_HYBRID_MAX_CHUNKS_PER_DOCUMENT', 1))
+# Background document ingestion (set ATAS_INGEST_WORKERS=0 on web nodes when a
+# separate `flask --app app ingest-worker` process does the work)
+INGEST_WORKERS = int(os.environ.get('ATAS_INGEST_WORKERS', 2))
+INGEST_POLL_INTERVAL = float(os.environ.get('ATAS_INGEST_POLL_INTERVAL', 5))
+INGEST_MAX_ATTEMPTS = int(os.environ.get('ATAS_INGEST_MAX_ATTEMPTS', 3))
+# A running job whose progress has not been updated for this long is re-claimed
+INGEST_LOCK_TIMEOUT = int(os.environ.get('ATAS_INGEST_LOCK_TIMEOUT', 600))
+PDF_EXTRACT_PROCESSES = int(os.environ.get('ATAS_PDF_EXTRACT_PROCESSES', min(4, os.cpu_count() or 1)))  # 0 extracts in-process
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('ATAS_PDF_PARALLEL_MIN_PAGES', 40))
+PDF_PAGES_PER_TASK = int(os.environ.get('ATAS_PDF_PAGES_PER_TASK', 20))
+PDF_EXTRACT_TIMEOUT = float(os.environ.get('ATAS_PDF_EXTRACT_TIMEOUT', 300))
+PDF_EXTRACT_START_METHOD = os.environ.get('ATAS_PDF_EXTRACT_START_METHOD', 'spawn')
 ALLOWED_EXTENSIONS = {'pdf', 'doc', 'docx'}
 
 app = Flask(__name__)
@@ -59,93 +170,658 @@ app.config.update(
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-class AuditLogger:
-    def __init__(self, db_config):
+# --- DATABASE CONNECTION POOL ---
+class PoolTimeoutError(psycopg2.pool.PoolError):
+    """Raised when no pooled connection frees up within ATAS_DB_POOL_TIMEOUT."""
+    pass
+
+class PooledConnection:
+    """A checked-out pool connection. close() hands it back to the pool instead of closing it."""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return getattr(conn, name)
+
+    def __setattr__(self, name, value):
+        # Session settings such as `conn.autocommit = True` must reach the real connection
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+            return
+        if self._conn is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        setattr(self._conn, name, value)
+
+    @property
+    def raw(self):
+        """The underlying psycopg2 connection, for APIs that need the real object."""
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.putconn(conn)
+
+class ConnectionPool:
+    """Thread-safe, bounded pool of psycopg2 connections owned by one worker process."""
+
+    def __init__(self, db_config, maxconn=5, timeout=10.0, check_after=30.0):
         self.db_config = db_config
-    
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_after = check_after
+        self._idle = []  # [(conn, returned_at)], most recently used last
+        self._size = 0   # physical connections open or being opened
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._counters = {
+            "checkouts": 0,
+            "connections_opened": 0,
+            "connections_discarded": 0,
+            "health_check_failures": 0,
+            "timeouts": 0,
+        }
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.db_config)
+        # Register the pgvector adapter once per physical connection
+        try:
+            pgvector.psycopg2.register_vector(conn)
+        except psycopg2.ProgrammingError as e:
+            app.logger.warning(f"pgvector not registered on pooled connection: {str(e)}")
+        conn.rollback()
+        with self._cond:
+            self._counters["connections_opened"] += 1
+        return conn
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    conn, returned_at = None, None
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise PoolTimeoutError(f"Timed out after {self.timeout}s waiting for a database connection")
+                self._waiting += 1
+                self._cond.wait(remaining)
+                self._waiting -= 1
+            self._in_use += 1
+            waited = time.monotonic() - started
+            self._counters["checkouts"] += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        try:
+            if conn is not None and not self._is_healthy(conn, returned_at):
+                with self._cond:
+                    self._counters["health_check_failures"] += 1
+                    self._counters["connections_discarded"] += 1
+                self._close_quietly(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, conn)
+
+    def putconn(self, conn):
+        discard = conn.closed or self._closed
+        if not discard:
+            try:
+                status = conn.info.transaction_status
+                if status == pg_extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != pg_extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()  # never leak an open transaction to the next checkout
+                if not discard and conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._size -= 1
+                self._counters["connections_discarded"] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if discard:
+            self._close_quietly(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._cond:
+            checkouts = self._counters["checkouts"]
+            return {
+                "pid": os.getpid(),
+                "max_size": self.maxconn,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "wait_time_total_ms": round(self._wait_total * 1000, 3),
+                "wait_time_avg_ms": round(self._wait_total * 1000 / checkouts, 3) if checkouts else 0.0,
+                "wait_time_max_ms": round(self._wait_max * 1000, 3),
+                **self._counters,
+            }
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Return this process's pool, creating a fresh one after a gunicorn fork."""
+    global _db_pool, _db_pool_pid
+    pid = os.getpid()
+    if _db_pool is None or _db_pool_pid != pid:
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != pid:
+                # Connections inherited from the parent are abandoned, not closed:
+                # closing them here would terminate the parent's sessions.
+                _db_pool = ConnectionPool(DB_CONFIG, maxconn=DB_POOL_SIZE,
+                                          timeout=DB_POOL_TIMEOUT, check_after=DB_POOL_CHECK_AFTER)
+                _db_pool_pid = pid
+    return _db_pool
+
+def get_db_connection():
+    """Check a connection out of the worker pool. conn.close() returns it to the pool."""
+    return get_db_pool().getconn()
+
+@contextmanager
+def db_connection():
+    """Context-manager checkout: `with db_connection() as conn:` releases the connection on exit."""
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+class AuditLogger:
+    """Writes audit_trail rows.
+
+    In 'async' mode log() only enqueues the row; a per-worker background thread
+    drains the bounded queue and flushes multi-row INSERTs when a batch fills up
+    or the flush interval elapses. 'sync' mode writes every row inside the
+    request, for deployments where an audit row must be durable before the
+    response goes out.
+    """
+
+    def __init__(self, connection_factory, mode='async', queue_size=10000, batch_size=200, flush_interval=1.0):
+        self.connection_factory = connection_factory
+        self.mode = mode
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._counters = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0}
+
     def log(self, user_id, action, target_id=None, metadata=None):
+        row = (user_id, action, target_id, json.dumps(metadata) if metadata else None, datetime.now(timezone.utc))
+        if self.mode == 'sync' or self._stop.is_set():
+            self._write([row])
+            return
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(row)
+            self._count("enqueued")
+        except queue.Full:
+            self._count("dropped")
+            app.logger.error(f"Audit queue full, dropped '{action}' for user {user_id}")
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def _ensure_worker(self):
+        pid = os.getpid()
+        if self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != pid:
+                # Fresh queue after a gunicorn fork; the parent's thread does not exist here
+                self._queue = queue.Queue(maxsize=self.queue_size)
+                self._pid = pid
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0 or self._stop.is_set():
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        if self._write(batch) or len(batch) == 1:
+            return
+        # One bad row (e.g. a dangling userID) should not cost the whole batch
+        for row in batch:
+            self._write([row])
+
+    def _write(self, rows):
         conn = None
         try:
-            conn = psycopg2.connect(**self.db_config)
+            conn = self.connection_factory()
             with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO audit_trail (userID, action, targetID, additional_info)
-                    VALUES (%s, %s, %s, %s::jsonb);
-                """, (user_id, action, target_id, json.dumps(metadata) if metadata else None))
-                conn.commit()
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO audit_trail (userID, action, targetID, additional_info, timestamp)
+                    VALUES %s;
+                """, rows, template="(%s, %s, %s, %s::jsonb, %s)", page_size=len(rows))
+            conn.commit()
+            self._count("written", len(rows))
+            self._count("batches")
+            return True
         except psycopg2.Error as e:
             app.logger.error(f"Audit log failed: {str(e)}")
             if conn: conn.rollback()
+            if len(rows) == 1:
+                self._count("failed")
+            return False
         finally:
             if conn: conn.close()
-        pass # Placeholder for your existing audit log code
+
+    def shutdown(self, timeout=10.0):
+        """Stop accepting queued rows and flush whatever is pending. Safe to call twice."""
+        self._stop.set()
+        if self._pid != os.getpid():
+            return
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+        pending = []
+        while True:
+            try:
+                pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for start in range(0, len(pending), self.batch_size):
+            self._flush(pending[start:start + self.batch_size])
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        own_queue = self._pid == os.getpid() and self._queue is not None
+        return {
+            "mode": self.mode,
+            "queue_depth": self._queue.qsize() if own_queue else 0,
+            "queue_capacity": self.queue_size,
+            "worker_alive": bool(own_queue and self._thread is not None and self._thread.is_alive()),
+            **counters,
+        }
+
+def audit_trail_filters(start_date, end_date):
+    """WHERE clause (alias `a`) and params for the audit trail date-range filters."""
+    where_clauses = []
+    query_params = []
+    if start_date:
+        where_clauses.append("a.timestamp >= %s")
+        query_params.append(start_date)
+    if end_date:
+        where_clauses.append("a.timestamp <= %s")
+        query_params.append(end_date)
+    where_sql = ("WHERE " + " AND ".join(where_clauses)) if where_clauses else ""
+    return where_sql, query_params
 
 @app.route("/api/audit-trail", methods=['GET'])
 def get_audit_trail():
+    """Audit log, newest first. Follow `next_cursor` for keyset paging; `page` is still accepted."""
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = 5
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
-    offset = (page - 1) * per_page
+    try:
+        count_mode = _count_mode()
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     conn = None
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
+        conn = get_db_connection()
         cur = conn.cursor()
+        where_sql, query_params = audit_trail_filters(start_date, end_date)
+
+        # Total count (cached or estimated; COUNT(*) per page request is a full scan)
+        total_items = count_listing(cur, f"FROM audit_trail a {where_sql}", query_params, count_mode)
+        total_pages = (total_items + per_page - 1) // per_page if total_items is not None else None
+
+        # Keyset: continue strictly after the last row of the previous page
+        offset = 0
+        if after:
+            keyset = "(a.timestamp, a.auditid) < (%s, %s)"
+            where_sql = f"{where_sql} AND {keyset}" if where_sql else f"WHERE {keyset}"
+            query_params.extend(after)
+        else:
+            offset = (page - 1) * per_page
+        query_params.extend([per_page + 1, offset])
 
-        query_params = []
-        where_clauses = []
-
-        # Base query and join
-        sql_base = """
-            FROM audit_trail a
-            LEFT JOIN users u ON a.userid = u.userid
-        """
-
-        # Add date filtering if provided
-        if start_date:
-            where_clauses.append("a.timestamp >= %s")
-            query_params.append(start_date)
-        if end_date:
-            where_clauses.append("a.timestamp <= %s")
-            query_params.append(end_date)
-        
-        where_sql = ""
-        if where_clauses:
-            where_sql = "WHERE " + " AND ".join(where_clauses)
-
-        # Get total count for pagination
-        cur.execute(f"SELECT COUNT(*) {sql_base} {where_sql}", query_params)
-        total_items = cur.fetchone()[0]
-        total_pages = (total_items + per_page - 1) // per_page
-        
-        # Add pagination parameters to the list for the final query
-        query_params.extend([per_page, offset])
-
-        # Get the logs for the current page using the CORRECT column names
         sql_select = f"""
             SELECT a.auditid, a.timestamp, u.email, a.action, a.targetid, a.additional_info
-            {sql_base} {where_sql}
-            ORDER BY a.timestamp DESC
+            FROM audit_trail a
+            LEFT JOIN users u ON a.userid = u.userid
+            {where_sql}
+            ORDER BY a.timestamp DESC, a.auditid DESC
             LIMIT %s OFFSET %s;
         """
         cur.execute(sql_select, query_params)
+        rows = cur.fetchall()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
         logs = [
             {"log_id": row[0], "timestamp": row[1], "email": row[2] or "System", "action": row[3], "target_id": row[4], "info": row[5]}
-            for row in cur.fetchall()
+            for row in rows
         ]
         
         return jsonify({
             "logs": logs,
-            "page": page,
-            "total_pages": total_pages
+            "page": None if after else page,
+            "total_pages": total_pages,
+            "total_items": total_items,
+            "next_cursor": encode_cursor(rows[-1][1], rows[-1][0]) if has_more else None
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
         if conn: conn.close()
 
-audit_logger = AuditLogger(DB_CONFIG)
+def require_role(*roles):
+    """Decorator to protect routes based on user role; any of the given roles is allowed."""
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if session.get('user_role') not in roles:
+                return jsonify({"error": "Unauthorized"}), 403
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
+
+# --- AUDIT TRAIL EXPORT ---
+AUDIT_EXPORT_COLUMNS = ("log_id", "timestamp", "email", "action", "target_id", "info")
+AUDIT_EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+def _audit_export_rows(start_date, end_date):
+    """Yield audit rows through a server-side cursor, AUDIT_EXPORT_FETCH_SIZE at a time."""
+    conn = get_db_connection()
+    try:
+        where_sql, query_params = audit_trail_filters(start_date, end_date)
+        # Named cursor: Postgres holds the result set, we only ever hold one batch
+        cur = conn.cursor(name=f"audit_export_{secrets.token_hex(4)}")
+        cur.itersize = AUDIT_EXPORT_FETCH_SIZE
+        cur.execute(f"""
+            SELECT a.auditid, a.timestamp, u.email, a.action, a.targetid, a.additional_info
+            FROM audit_trail a
+            LEFT JOIN users u ON a.userid = u.userid
+            {where_sql}
+            ORDER BY a.timestamp, a.auditid;
+        """, query_params)
+        for row in cur:
+            yield row
+        cur.close()
+    finally:
+        conn.close()
+
+def _audit_export_lines(rows, fmt):
+    """Serialize audit rows as CSV or NDJSON text, one line per row."""
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(AUDIT_EXPORT_COLUMNS)
+        for row in rows:
+            info = json.dumps(row[5], default=str) if row[5] is not None else ""
+            writer.writerow([row[0], row[1].isoformat() if row[1] else "", row[2] or "System", row[3], row[4], info])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for row in rows:
+            record = dict(zip(AUDIT_EXPORT_COLUMNS, row))
+            record["email"] = record["email"] or "System"
+            record["timestamp"] = row[1].isoformat() if row[1] else None
+            yield json.dumps(record, default=str) + "\n"
+
+def _encode_stream(lines, compress, flush_bytes=64 * 1024):
+    """UTF-8 encode (and optionally gzip) a line stream in ~flush_bytes pieces."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    pending = []
+    size = 0
+    for line in lines:
+        data = line.encode('utf-8')
+        pending.append(data)
+        size += len(data)
+        if size >= flush_bytes:
+            block = b"".join(pending)
+            pending, size = [], 0
+            block = compressor.compress(block) if compressor else block
+            if block:
+                yield block
+    block = b"".join(pending)
+    if compressor:
+        block = compressor.compress(block) + compressor.flush()
+    if block:
+        yield block
+
+@app.route("/api/audit-trail/export", methods=['GET'])
+@require_role('IT Administrator', 'Super Administrator')
+def export_audit_trail():
+    """Streams the full audit trail (optionally date-filtered) as CSV or NDJSON, optionally gzipped."""
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in AUDIT_EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of: {', '.join(AUDIT_EXPORT_FORMATS)}"}), 400
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    for name, value in (("start_date", start_date), ("end_date", end_date)):
+        if value:
+            try:
+                datetime.fromisoformat(value)
+            except ValueError:
+                return jsonify({"error": f"{name} must be an ISO 8601 date or timestamp."}), 400
+    compress = _bool_param('gzip', None) or 'gzip' in request.headers.get('Accept-Encoding', '').lower()
+
+    # Run the query and fetch the first batch now, so a failure is still an error
+    # status rather than a 200 whose body stops short
+    rows = _audit_export_rows(start_date, end_date)
+    try:
+        first = next(rows, None)
+    except psycopg2.DataError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    rows = itertools.chain([first], rows) if first is not None else iter(())
+
+    filename = f"audit_trail_{datetime.now(timezone.utc):%Y%m%d_%H%M%S}.{fmt}"
+    body = _encode_stream(_audit_export_lines(rows, fmt), compress)
+    response = Response(body, mimetype=AUDIT_EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+audit_logger = AuditLogger(get_db_connection, mode=AUDIT_MODE, queue_size=AUDIT_QUEUE_SIZE,
+                           batch_size=AUDIT_BATCH_SIZE, flush_interval=AUDIT_FLUSH_INTERVAL)
+# gunicorn.conf.py also calls shutdown() from its worker_exit hook
+atexit.register(audit_logger.shutdown)
+
+# --- AUDIT TRAIL PARTITIONS ---
+# audit_trail is range-partitioned by month (migration 0011). Partitions are
+# named audit_trail_YYYY_MM; audit_trail_default catches anything outside them.
+def _month_start(day, offset=0):
+    month = day.year * 12 + day.month - 1 + offset
+    return datetime(month // 12, month % 12 + 1, 1).date()
+
+def audit_partition_name(month):
+    return f"audit_trail_{month:%Y_%m}"
+
+def ensure_audit_partitions(conn, months_ahead=AUDIT_PARTITION_MONTHS_AHEAD):
+    """Create monthly partitions from the current month through months_ahead. Returns the names created.
+
+    A month that already has rows in the default partition gets them moved
+    into its new partition, since ATTACH refuses overlapping default rows.
+    """
+    created = []
+    today = datetime.now(timezone.utc).date()
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('audit_trail');")
+        if not cur.fetchone():
+            return created  # migration 0011 not applied yet
+        for offset in range(months_ahead + 1):
+            low, high = _month_start(today, offset), _month_start(today, offset + 1)
+            name = audit_partition_name(low)
+            cur.execute("SELECT to_regclass(%s);", (name,))
+            if cur.fetchone()[0]:
+                continue
+            cur.execute(f"CREATE TABLE {name} (LIKE audit_trail INCLUDING DEFAULTS);")
+            cur.execute(f"""
+                WITH moved AS (
+                    DELETE FROM audit_trail_default WHERE timestamp >= %s AND timestamp < %s RETURNING *
+                )
+                INSERT INTO {name} SELECT * FROM moved;
+            """, (low, high))
+            cur.execute(f"ALTER TABLE audit_trail ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s);", (low, high))
+            conn.commit()
+            created.append(name)
+    return created
+
+_audit_partitions_checked = {"pid": None, "at": 0.0}
+_audit_partitions_lock = threading.Lock()
+
+def maintain_audit_partitions():
+    """Run ensure_audit_partitions in the background at most once per check interval per worker."""
+    now = time.monotonic()
+    state = _audit_partitions_checked
+    if state["pid"] == os.getpid() and now - state["at"] < AUDIT_PARTITION_CHECK_INTERVAL:
+        return
+    if not _audit_partitions_lock.acquire(blocking=False):
+        return
+    state["pid"], state["at"] = os.getpid(), now
+
+    def run():
+        try:
+            with db_connection() as conn:
+                for name in ensure_audit_partitions(conn):
+                    app.logger.info("Created audit partition %s", name)
+        except Exception as e:
+            # Rows still land in audit_trail_default; the next check retries
+            app.logger.warning("Audit partition maintenance failed: %s", e)
+        finally:
+            _audit_partitions_lock.release()
+
+    threading.Thread(target=run, name="audit-partitions", daemon=True).start()
+
+def list_audit_partitions(cur):
+    """(name, month) for every monthly partition table, oldest first.
+
+    Includes tables already detached by an interrupted archive run, so a
+    rerun picks them up again.
+    """
+    cur.execute("""
+        SELECT relname FROM pg_class
+        WHERE relkind = 'r' AND relname ~ '^audit_trail_[0-9]{4}_[0-9]{2}$' AND pg_table_is_visible(oid)
+        ORDER BY relname;
+    """)
+    return [(name, datetime.strptime(name[len("audit_trail_"):], "%Y_%m").date()) for (name,) in cur.fetchall()]
+
+def archive_audit_partition(conn, name, archive_dir, drop=True):
+    """Detach a monthly partition, dump it to <archive_dir>/<name>.csv.gz and (by default) drop it.
+
+    Returns the archive path. The table is only dropped after the dump has
+    been written and fsynced, so a failed dump leaves it detached but intact.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s) AND inhparent = 'audit_trail'::regclass;
+        """, (name,))
+        if cur.fetchone():
+            cur.execute(f"ALTER TABLE audit_trail DETACH PARTITION {name};")
+            conn.commit()
+        partial = path + ".part"
+        with open(partial, "wb") as raw:
+            with gzip.GzipFile(filename=f"{name}.csv", mode="wb", fileobj=raw) as out:
+                cur.copy_expert(f"COPY (SELECT * FROM {name} ORDER BY timestamp, auditid) TO STDOUT WITH CSV HEADER", out)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(partial, path)
+        if drop:
+            cur.execute(f"DROP TABLE {name};")
+        conn.commit()
+    return path
 
 @app.before_request
 def load_user_id_to_g():
@@ -221,116 +897,1836 @@ def log_system_action(action, target_type=None, target_id=None, details=None):
 def load_user_from_session():
     g.user_id = session.get('user_id')
 
+@app.before_request
+def start_background_workers():
+    # Threads cannot survive a gunicorn fork, so each worker starts its own on first request
+    ingestion_workers.ensure_started()
+    maintain_audit_partitions()
+
 # --- HELPER FUNCTIONS ---
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# --- HELPER FUNCTIONS ---
-def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
-
 # --- NEW HELPER FUNCTIONS ---
-def get_embedding(text, model="text-embedding-ada-002"):
-   text = text.replace("\n", " ")
-   embedding = client.embeddings.create(input=[text], model=model).data[0].embedding
-   return np.array(embedding) # Return as a numpy array
+# Transient OpenAI failures worth retrying; anything else is raised immediately
+RETRYABLE_OPENAI_ERRORS = (openai.RateLimitError, openai.APITimeoutError,
+                           openai.APIConnectionError, openai.InternalServerError)
+
+def call_with_backoff(fn, *args, max_retries=None, base_delay=1.0, max_delay=60.0, **kwargs):
+    """Call an OpenAI client method, retrying transient errors with capped exponential backoff and jitter."""
+    max_retries = OPENAI_MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except RETRYABLE_OPENAI_ERRORS as e:
+            attempt += 1
+            if attempt > max_retries:
+                raise
+            delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+            delay = random.uniform(delay / 2, delay)
+            # Honour the server's Retry-After hint when it asks for a longer pause
+            response = getattr(e, 'response', None)
+            retry_after = response.headers.get('retry-after') if response is not None else None
+            if retry_after:
+                try:
+                    delay = min(max_delay, max(delay, float(retry_after)))
+                except ValueError:
+                    pass
+            app.logger.warning(f"OpenAI call failed ({type(e).__name__}), retry {attempt}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+def estimate_tokens(text):
+    """Conservative token estimate (~3 characters per token) used to size API requests."""
+    return len(text) // 3 + 1
+
+def _embedding_batches(texts, max_items, max_tokens):
+    batch, batch_tokens = [], 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+class EmbeddingProvider(ABC):
+    """Turns texts into embedding vectors. `model_id` is what gets recorded on each chunk row."""
+    name = None
+
+    def __init__(self, model):
+        self.model = model
+
+    @property
+    def model_id(self):
+        return f"{self.name}:{self.model}"
+
+    @property
+    @abstractmethod
+    def dimension(self):
+        """Length of the vectors embed() returns."""
+
+    @abstractmethod
+    def embed(self, texts):
+        """One numpy vector per text, in input order."""
+
+    def stats(self):
+        return {"provider": self.name, "model": self.model, "model_id": self.model_id}
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """Remote embeddings, packing as many texts as the per-request item and token limits allow into each call."""
+    name = "openai"
+    KNOWN_DIMENSIONS = {"text-embedding-ada-002": 1536, "text-embedding-3-small": 1536, "text-embedding-3-large": 3072}
+
+    def __init__(self, model, batch_size=256, max_batch_tokens=250000):
+        super().__init__(model)
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self._dimension = self.KNOWN_DIMENSIONS.get(model)
+
+    @property
+    def dimension(self):
+        if self._dimension is None:
+            self._dimension = len(self.embed(["dimension probe"])[0])
+        return self._dimension
+
+    def embed(self, texts):
+        embeddings = []
+        cleaned = [text.replace("\n", " ") for text in texts]
+        for batch in _embedding_batches(cleaned, self.batch_size, self.max_batch_tokens):
+            response = call_with_backoff(client.embeddings.create, input=batch, model=self.model)
+            for item in sorted(response.data, key=lambda d: d.index):
+                # pgvector stores float32, so there is nothing to gain from keeping float64 around
+                embeddings.append(np.array(item.embedding, dtype=np.float32))
+        return embeddings
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """sentence-transformers model run with torch on this host.
+
+    The model is loaded lazily, once per worker process (a model inherited
+    through fork is not reused), with torch limited to `threads` intra-op
+    threads so gunicorn workers don't oversubscribe the CPU. Inference is
+    serialized per process; each call is internally batched by `batch_size`.
+    Vectors are L2-normalized, which is what cosine search expects.
+    """
+    name = "local"
+
+    def __init__(self, model, batch_size=32, threads=2, device="cpu"):
+        super().__init__(model)
+        self.batch_size = batch_size
+        self.threads = threads
+        self.device = device
+        self._model = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._counters = {"texts": 0, "seconds": 0.0}
+
+    def _load(self):
+        pid = os.getpid()
+        if self._model is not None and self._pid == pid:
+            return self._model
+        with self._lock:
+            if self._model is None or self._pid != pid:
+                import torch
+                from sentence_transformers import SentenceTransformer
+                torch.set_num_threads(max(1, self.threads))
+                started = time.perf_counter()
+                self._model = SentenceTransformer(self.model, device=self.device)
+                self._model.eval()
+                self._pid = pid
+                app.logger.info(f"Loaded embedding model {self.model} in {time.perf_counter() - started:.1f}s")
+        return self._model
+
+    @property
+    def dimension(self):
+        return self._load().get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        if not texts:
+            return []
+        model = self._load()
+        started = time.perf_counter()
+        with self._lock:
+            vectors = model.encode(list(texts), batch_size=self.batch_size, convert_to_numpy=True,
+                                   normalize_embeddings=True, show_progress_bar=False)
+            self._counters["texts"] += len(texts)
+            self._counters["seconds"] += time.perf_counter() - started
+        return list(vectors)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        return {**super().stats(), "loaded": self._model is not None and self._pid == os.getpid(),
+                "threads": self.threads, "batch_size": self.batch_size, **counters}
+
+def create_embedding_provider(provider=EMBEDDING_PROVIDER, model=None):
+    if provider == "openai":
+        return OpenAIEmbeddingProvider(model or EMBEDDING_MODEL, batch_size=EMBEDDING_BATCH_SIZE,
+                                       max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS)
+    if provider == "local":
+        return LocalEmbeddingProvider(model or LOCAL_EMBEDDING_MODEL, batch_size=LOCAL_EMBEDDING_BATCH_SIZE,
+                                      threads=LOCAL_EMBEDDING_THREADS, device=LOCAL_EMBEDDING_DEVICE)
+    raise ValueError(f"Unknown ATAS_EMBEDDING_PROVIDER '{provider}' (expected 'openai' or 'local').")
+
+# The configured provider. Once a re-embedding has been cut over, embedding_state
+# (not the environment) says which model document_chunks.embedding holds.
+embedding_provider = create_embedding_provider()
+_embedding_providers = {embedding_provider.model_id: embedding_provider}
+_active_embedding = {"version": None, "provider": embedding_provider}
+_active_embedding_lock = threading.Lock()
+
+def embedding_provider_for(model_id):
+    """Provider instance for a recorded model_id ('openai:<model>' / 'local:<model>'), one per process."""
+    with _active_embedding_lock:
+        provider = _embedding_providers.get(model_id)
+        if provider is None:
+            name, _, model = model_id.partition(":")
+            provider = _embedding_providers[model_id] = create_embedding_provider(name, model)
+        return provider
+
+def read_embedding_state(cur):
+    """model_id that document_chunks.embedding holds, or None for an empty corpus.
+
+    embedding_state wins once a re-embedding cutover has written it; before that
+    the model recorded on the chunks themselves does, whatever the environment now
+    configures, so a provider change alone never pairs query vectors with another model's.
+    """
+    cur.execute("SELECT to_regclass('embedding_state') IS NOT NULL;")
+    if cur.fetchone()[0]:  # migration 0016 may not be applied yet
+        cur.execute("SELECT model_id FROM embedding_state;")
+        row = cur.fetchone()
+        if row:
+            return row[0]
+    cur.execute("SELECT embedding_model FROM document_chunks WHERE embedding_model IS NOT NULL LIMIT 1;")
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def active_embedding_provider():
+    """Provider matching document_chunks.embedding, re-read whenever the 'embedding' cache version moves."""
+    version = cache_versions.get('embedding')
+    if _active_embedding["version"] != version:
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    model_id = read_embedding_state(cur)
+        except psycopg2.Error as e:
+            app.logger.warning(f"Could not read embedding_state: {str(e)}")
+            return _active_embedding["provider"]
+        provider = embedding_provider_for(model_id) if model_id else embedding_provider
+        with _active_embedding_lock:
+            _active_embedding.update(version=version, provider=provider)
+    return _active_embedding["provider"]
+
+def locked_embedding_provider(cur):
+    """Like active_embedding_provider(), but read inside the caller's transaction after locking document_chunks.
+
+    A re-embedding cutover swaps the embedding column under an ACCESS EXCLUSIVE
+    lock, so it either committed before this read or waits for the caller's
+    transaction to end; the caller never pairs one model's vectors with the other's column.
+    """
+    cur.execute("LOCK TABLE document_chunks IN ACCESS SHARE MODE;")
+    model_id = read_embedding_state(cur)
+    provider = embedding_provider_for(model_id) if model_id else embedding_provider
+    with _active_embedding_lock:
+        _active_embedding["provider"] = provider
+    return provider
+
+def get_embeddings(texts, provider=None):
+    """Embed many texts with the active provider (or the one given)."""
+    return (provider or active_embedding_provider()).embed(texts)
+
+def get_embedding(text, provider=None):
+    return get_embeddings([text], provider=provider)[0]
+
+def embedding_column_dimension(cur, column="embedding"):
+    """Declared dimension of a document_chunks vector column (None if untyped or missing)."""
+    cur.execute("""
+        SELECT atttypmod FROM pg_attribute
+        WHERE attrelid = 'document_chunks'::regclass AND attname = %s AND NOT attisdropped;
+    """, (column,))
+    row = cur.fetchone()
+    return row[0] if row and row[0] > 0 else None
+
+def check_embedding_dimension(cur, provider=None, column="embedding"):
+    """Raise if the provider's vectors cannot be stored in (or compared with) the column."""
+    provider = provider or active_embedding_provider()
+    expected = embedding_column_dimension(cur, column)
+    if expected is not None and provider.dimension != expected:
+        raise ValueError(f"{provider.model_id} produces {provider.dimension}-dimensional vectors but "
+                         f"document_chunks.{column} is vector({expected}); re-embed the corpus first.")
+
+class EmbeddingCache:
+    """Bounded LRU + TTL cache of query embeddings, keyed by (model, normalized query).
+
+    Local misses fall through to an optional Postgres tier (query_embedding_cache),
+    so an embedding any gunicorn worker has paid for is shared by all of them.
+    """
+
+    def __init__(self, max_entries=1000, ttl=86400, persistent=True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persistent = persistent
+        self._entries = OrderedDict()  # key -> (expires_at, embedding)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0,
+                          "persistent_hits": 0, "persistent_errors": 0}
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.lower().split())
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def get_or_compute(self, text, model, compute):
+        """Return the cached embedding for text, calling compute(normalized_text, model) on a full miss."""
+        normalized = self.normalize(text)
+        key = (model, normalized)
+        embedding = self._get_local(key)
+        if embedding is not None:
+            return embedding
+        embedding = self._get_persistent(model, normalized) if self.persistent else None
+        if embedding is None:
+            self._count("misses")
+            embedding = compute(normalized, model)
+            if self.persistent:
+                self._put_persistent(model, normalized, embedding)
+        self._put_local(key, embedding)
+        return embedding
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                self._counters["expirations"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return entry[1]
+
+    def _put_local(self, key, embedding):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    @staticmethod
+    def _digest(normalized):
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def _get_persistent(self, model, normalized):
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT embedding FROM query_embedding_cache
+                        WHERE model = %s AND query_hash = %s AND created_at > NOW() - %s * INTERVAL '1 second';
+                    """, (model, self._digest(normalized), self.ttl))
+                    row = cur.fetchone()
+        except psycopg2.Error as e:
+            app.logger.warning(f"Embedding cache lookup failed: {str(e)}")
+            self._count("persistent_errors")
+            return None
+        if row is None:
+            return None
+        self._count("persistent_hits")
+        return np.asarray(row[0])
+
+    def _put_persistent(self, model, normalized, embedding):
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO query_embedding_cache (model, query_hash, query_text, embedding)
+                        VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (model, query_hash)
+                        DO UPDATE SET embedding = EXCLUDED.embedding, created_at = NOW();
+                    """, (model, self._digest(normalized), normalized, embedding))
+                    if random.random() < 0.01:  # occasionally prune expired rows
+                        cur.execute("DELETE FROM query_embedding_cache WHERE created_at < NOW() - %s * INTERVAL '1 second';",
+                                    (self.ttl,))
+                conn.commit()
+        except psycopg2.Error as e:
+            app.logger.warning(f"Embedding cache store failed: {str(e)}")
+            self._count("persistent_errors")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "persistent": self.persistent,
+                **self._counters,
+            }
+
+query_embedding_cache = EmbeddingCache(max_entries=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL,
+                                       persistent=EMBEDDING_CACHE_PERSISTENT)
+
+def get_query_embedding(query, provider=None):
+    """Embedding for a search query, served from the query embedding cache when possible."""
+    provider = provider or active_embedding_provider()
+    # Keyed by model_id, so switching providers never serves another model's vectors
+    return query_embedding_cache.get_or_compute(query, provider.model_id,
+                                                lambda text, model: get_embedding(text, provider=provider))
+
+class TTLCache:
+    """Small thread-safe LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self._counters["expirations"] += 1
+                entry = None
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_entries": self.max_entries, "ttl_seconds": self.ttl, **self._counters}
+
+class CacheVersions:
+    """Version counters shared through the cache_versions table.
+
+    Writers call bump() after committing a change; cached entries are keyed by
+    the version they were built under, so a bump makes them unreachable in every
+    worker. Readers re-read a counter at most once per `check_interval` seconds.
+    """
+
+    def __init__(self, check_interval=2.0):
+        self.check_interval = check_interval
+        self._local = {}  # name -> (version, checked_at)
+        self._lock = threading.Lock()
+        self._unshared = itertools.count(-1, -1)
+
+    def get(self, name):
+        with self._lock:
+            cached = self._local.get(name)
+        if cached and time.monotonic() - cached[1] < self.check_interval:
+            return cached[0]
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT version FROM cache_versions WHERE name = %s;", (name,))
+                    row = cur.fetchone()
+        except psycopg2.Error as e:
+            # No shared counter (e.g. migration 0004 not applied): hand out a version nothing
+            # was cached under, so callers see a miss instead of failing; a new one follows
+            # every check_interval, like a bump from another worker would
+            app.logger.warning(f"Could not read cache version '{name}': {str(e)}")
+            with self._lock:
+                version = next(self._unshared)
+                self._local[name] = (version, time.monotonic())
+            return version
+        version = row[0] if row else 0
+        with self._lock:
+            self._local[name] = (version, time.monotonic())
+        return version
+
+    def bump(self, name):
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO cache_versions (name, version) VALUES (%s, 1)
+                        ON CONFLICT (name) DO UPDATE SET version = cache_versions.version + 1
+                        RETURNING version;
+                    """, (name,))
+                    version = cur.fetchone()[0]
+                conn.commit()
+        except psycopg2.Error as e:
+            # Entries built before the change now live until their TTL runs out
+            app.logger.error(f"Could not bump cache version '{name}': {str(e)}")
+            with self._lock:
+                self._local.pop(name, None)
+            return None
+        with self._lock:
+            self._local[name] = (version, time.monotonic())
+        return version
+
+cache_versions = CacheVersions(check_interval=CACHE_VERSION_CHECK_INTERVAL)
+search_result_cache = TTLCache(max_entries=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+
+def search_cache_key(query, filters):
+    """Stable digest of the normalized query text plus every option that changes the result list."""
+    payload = json.dumps({"q": EmbeddingCache.normalize(query), "filters": filters}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def json_bytes_response(body, etag=None, status=200):
+    """Response for an already-serialized JSON payload (skips jsonify on cache hits)."""
+    response = Response(body, status=status, mimetype='application/json')
+    if etag:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# --- REFERENCE DATA CACHE ---
+# Small lookup tables that only change through their admin CRUD routes. Each
+# GET serves pre-serialized bytes; the writers call reference_cache.invalidate().
+REFERENCE_DATASETS = {
+    "financial_services": (
+        "SELECT serviceid AS id, servicename AS name, description FROM financial_services ORDER BY servicename;",
+        lambda row: {"id": row[0], "name": row[1], "description": row[2]},
+    ),
+    "regulators": (
+        "SELECT regulatorid AS id, name, abbreviation FROM regulators ORDER BY name;",
+        lambda row: {"id": row[0], "name": row[1], "abbreviation": row[2]},
+    ),
+    "document_types": (
+        "SELECT typeid AS id, typename AS name FROM document_types ORDER BY typename;",
+        lambda row: {"id": row[0], "name": row[1]},
+    ),
+    "user_types": (
+        "SELECT usertypeid AS id, typename AS name FROM user_types ORDER BY typename;",
+        lambda row: {"id": row[0], "name": row[1]},
+    ),
+    "roles": (
+        "SELECT roleid, rolename FROM roles ORDER BY rolename;",
+        lambda row: {"roleID": row[0], "roleName": row[1]},
+    ),
+}
+
+class ReferenceDataCache:
+    """Serialized JSON (plus an ETag) for each REFERENCE_DATASETS entry, per worker.
+
+    Entries expire after `ttl` seconds. invalidate() drops the local copy and
+    sends NOTIFY on `channel`; a listener thread in every worker drops its own
+    copy when the notification arrives. Notifications sent while a listener is
+    reconnecting are lost, so it clears everything once it is listening again
+    and the TTL bounds staleness in between.
+    """
+
+    def __init__(self, ttl=600, channel='atas_reference_data'):
+        self.ttl = ttl
+        self.channel = channel
+        self._entries = {}  # name -> (body, etag, expires_at)
+        self._generations = {}  # name -> invalidation count, so a slow load cannot store stale rows
+        self._lock = threading.Lock()
+        self._pid = None
+        self._listening = False
+        self._counters = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, name):
+        """(body, etag) for a dataset, loading it from the database on a miss."""
+        self._ensure_listener()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and entry[2] > now:
+                self._counters["hits"] += 1
+                return entry[0], entry[1]
+            self._counters["misses"] += 1
+            generation = self._generations.get(name, 0)
+        sql, to_dict = REFERENCE_DATASETS[name]
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql)
+                rows = [to_dict(row) for row in cur.fetchall()]
+        body = json.dumps(rows, default=str).encode('utf-8')
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        with self._lock:
+            if self._generations.get(name, 0) == generation:
+                self._entries[name] = (body, etag, now + self.ttl)
+        return body, etag
+
+    def invalidate(self, name):
+        """Call after committing a change to the dataset's table."""
+        self._drop(name)
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_notify(%s, %s);", (self.channel, name))
+                conn.commit()
+        except psycopg2.Error as e:
+            app.logger.error(f"Could not notify reference cache invalidation '{name}': {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "listening": self._listening, "ttl": self.ttl, **self._counters}
+
+    def _drop(self, name=None):
+        with self._lock:
+            names = list(self._entries) if name is None else [name]
+            for key in names:
+                self._entries.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+            self._counters["invalidations"] += 1
+
+    def _ensure_listener(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self._entries.clear()
+            self._listening = False
+            threading.Thread(target=self._listen, name="reference-cache-listener", daemon=True).start()
+
+    def _listen(self):
+        delay = 1.0
+        while True:
+            conn = None
+            try:
+                # A dedicated connection: LISTEN state must not leak into the pool
+                conn = psycopg2.connect(**DB_CONFIG)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel};")
+                self._drop()
+                self._listening = True
+                delay = 1.0
+                while True:
+                    if select.select([conn], [], [], 60.0)[0]:
+                        conn.poll()
+                    else:
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT 1;")  # idle: make sure the connection is still alive
+                    while conn.notifies:
+                        self._drop(conn.notifies.pop(0).payload)
+            except Exception as e:
+                self._listening = False
+                app.logger.warning(f"Reference cache listener disconnected: {str(e)}")
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 60.0)
+
+reference_cache = ReferenceDataCache(ttl=REFERENCE_CACHE_TTL)
+
+def reference_data_response(name):
+    try:
+        body, etag = reference_cache.get(name)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if request.if_none_match.contains(etag):
+        return json_bytes_response(b"", etag=etag, status=304)
+    return json_bytes_response(body, etag=etag)
+
+# --- PAGINATION HELPERS ---
+# Listings page by keyset: the client sends back the opaque `cursor` from the
+# previous page, so page N costs one index range scan, the same as page 1.
+# Cursor values that JSON can't carry are tagged with their type
+_CURSOR_TYPES = {"dt": datetime, "d": date}
+
+def _cursor_value(value):
+    if isinstance(value, datetime):  # before date: datetime is a date subclass
+        return {"dt": value.isoformat()}
+    if isinstance(value, date):
+        return {"d": value.isoformat()}
+    return value
+
+def encode_cursor(*values):
+    payload = json.dumps([_cursor_value(v) for v in values])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(token, size=2):
+    """Inverse of encode_cursor. Raises ValueError for anything that was not produced by it."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if not isinstance(values, list) or len(values) != size:
+            raise ValueError
+        decoded = []
+        for value in values:
+            if isinstance(value, dict):
+                (tag, text), = value.items()
+                value = _CURSOR_TYPES[tag].fromisoformat(text)
+            decoded.append(value)
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Invalid cursor.")
+    return decoded
+
+listing_count_cache = TTLCache(max_entries=512, ttl=LISTING_COUNT_CACHE_TTL)
+
+def count_listing(cur, from_where_sql, params, mode):
+    """Total rows for a listing.
+
+    'exact' runs COUNT(*); 'cached' reuses an exact count for LISTING_COUNT_CACHE_TTL
+    seconds; 'approx' takes the planner's row estimate (no scan); 'none' skips it.
+    """
+    if mode == 'none':
+        return None
+    if mode == 'approx':
+        cur.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 {from_where_sql}", params)
+        plan = cur.fetchone()[0]
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        return int(plan[0]["Plan"]["Plan Rows"])
+    key = (from_where_sql, tuple(params))
+    if mode == 'cached':
+        total = listing_count_cache.get(key)
+        if total is not None:
+            return total
+    cur.execute(f"SELECT COUNT(*) {from_where_sql}", params)
+    total = cur.fetchone()[0]
+    listing_count_cache.put(key, total)
+    return total
+
+def _count_mode(default='cached'):
+    mode = request.args.get('count', default)
+    if mode not in ('exact', 'cached', 'approx', 'none'):
+        raise ValueError("count must be one of exact, cached, approx, none.")
+    return mode
+
+# --- TEXT NORMALIZATION ---
+# One precompiled alternation per profile, applied in a single re.sub pass
+# after NFKC (which already folds ligatures like "\ufb01" and full-width forms).
+_HYPHEN_BREAK = r'(?P<hyphen>\b(?P<head>[A-Za-z]+)-[ \t]*\r?\n\s*(?P<tail>[a-z]+)\b)'   # "require-\nment"
+_SPLIT_WORD = r'(?P<split>\b(?P<left>[A-Za-z]+)[ ]{1,2}(?=(?P<right>[a-z]+)\b))'        # "busi ness"
+_SPACE_OR_DROP = r'(?P<space>\s+)|(?P<drop>[\u00ad\u200b\u200c\u200d\ufeff])'         # soft hyphen, zero-width chars
+_NORMALIZE_PATTERNS = {
+    True: re.compile("|".join((_HYPHEN_BREAK, _SPLIT_WORD, _SPACE_OR_DROP))),
+    False: re.compile("|".join((_HYPHEN_BREAK, _SPACE_OR_DROP))),
+}
+_DROP_CHARS = dict.fromkeys(map(ord, "\u00ad\u200b\u200c\u200d\ufeff"))
+
+def load_wordlist(path):
+    """Lower-cased words from a one-word-per-line file, or None if it is missing."""
+    if not path or not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        return frozenset(line.strip().lower() for line in f if line.strip().isalpha())
+
+class TextNormalizer:
+    """Single-pass text normalization, with a 'document' and a 'query' profile.
+
+    Both profiles apply NFKC, drop soft hyphens and zero-width characters, and
+    collapse whitespace. The document profile also repairs PDF line-break
+    hyphenation. With a dictionary it rejoins "require-\nment" only when the
+    joined word is known, or the halves are not both words ("risk-\nbased"
+    keeps its hyphen). It also rejoins "busi ness" when the joined word is
+    known and one of the halves is not. Without a dictionary, line-break
+    hyphens are always joined and spaced-out words are left alone. Queries
+    are typed by people, so the query profile never joins words.
+    """
+
+    def __init__(self, profile="document", dictionary=None):
+        if profile not in ("document", "query"):
+            raise ValueError("profile must be 'document' or 'query'.")
+        self.profile = profile
+        self.dictionary = dictionary
+        # Without a dictionary the split-word branch could never fire, so leave it out of the scan
+        self._pattern = _NORMALIZE_PATTERNS[dictionary is not None]
+
+    def __call__(self, text):
+        if not text:
+            return ""
+        text = unicodedata.normalize("NFKC", text)
+        if self.profile == "query":
+            return " ".join(text.translate(_DROP_CHARS).split())
+        return self._pattern.sub(self._replace, text).strip()
+
+    def _known(self, word):
+        return word.lower() in self.dictionary
+
+    def _replace(self, match):
+        kind = match.lastgroup
+        if kind == "space":
+            return " "
+        if kind == "drop":
+            return ""
+        if kind == "hyphen":
+            head, tail = match.group("head"), match.group("tail")
+            if self.dictionary is None or self._known(head + tail) or not (self._known(head) and self._known(tail)):
+                return head + tail
+            return f"{head}-{tail}"
+        # split: decide on the space after `left`; `right` is only looked at
+        left = match.group("left")
+        if self.dictionary is not None:
+            right = match.group("right")
+            if self._known(left + right) and not (self._known(left) and self._known(right)):
+                return left
+        return left + " "
+
+document_normalizer = TextNormalizer("document", dictionary=load_wordlist(NORMALIZER_WORDLIST))
+query_normalizer = TextNormalizer("query")
 
 def clean_text(text):
-    """A simple function to clean up common text extraction errors."""
-    # Corrects words that are incorrectly split by a space (e.g., "busi ness" -> "business")
-    text = re.sub(r'(\w)\s{1,2}(\w)', r'\1\2', text)
-    # Removes hyphenation at the end of a line (e.g., "require-\nment" -> "requirement")
-    text = re.sub(r'(\w)-\n(\w)', r'\1\2', text)
-    # Replaces multiple spaces or newlines with a single space
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
+    """Normalize extracted document text (see TextNormalizer)."""
+    return document_normalizer(text)
+
+def clean_query(text):
+    """Normalize a search query: no word joining, just Unicode and whitespace cleanup."""
+    return query_normalizer(text)
+
+def iter_pdf_pages(file_stream):
+    """Yield (page_number, text) one page at a time, starting at 1. A page that fails to extract yields ''."""
+    pdf_reader = PyPDF2.PdfReader(file_stream)
+    for number, page in enumerate(pdf_reader.pages, start=1):
+        try:
+            text = page.extract_text() or ""
+        except Exception as e:
+            app.logger.warning(f"Could not extract page {number}: {str(e)}")
+            text = ""
+        yield number, text
+
+class PDFExtractionTimeout(Exception):
+    pass
+
+class PDFExtractor:
+    """Page text extraction in a per-worker pool of child processes.
+
+    PyPDF2 is pure Python and holds the GIL, so large PDFs are split into
+    `pages_per_task` page ranges extracted on separate cores; documents under
+    `parallel_min_pages` go to one child as a single task. Children are
+    spawned, not forked, so they inherit no threads or pooled connections.
+    The time spent waiting on one document is capped at `timeout`: a PDF that
+    hangs or kills the parser is abandoned, the pool is torn down and
+    PDFExtractionTimeout is raised, leaving the web process untouched.
+    """
+
+    def __init__(self, processes=4, parallel_min_pages=40, pages_per_task=20, timeout=300.0, start_method='spawn'):
+        self.processes = processes
+        self.parallel_min_pages = parallel_min_pages
+        self.pages_per_task = pages_per_task
+        self.timeout = timeout
+        self.start_method = start_method
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def iter_pages(self, path):
+        """Yield (page_number, text) in page order; at most 2 * processes ranges are extracted ahead."""
+        if self.processes <= 0:
+            yield from iter_pdf_pages(path)
+            return
+        pool = self._get_pool()
+        budget = {"remaining": self.timeout}
+
+        def wait(result):
+            started = time.monotonic()
+            try:
+                return result.get(timeout=max(0.0, budget["remaining"]))
+            except multiprocessing.TimeoutError:
+                self._discard_pool(pool)
+                raise PDFExtractionTimeout(f"PDF extraction exceeded {self.timeout:g}s: {path}")
+            finally:
+                budget["remaining"] -= time.monotonic() - started
+
+        pages = wait(pool.apply_async(pdf_extract.page_count, (path,)))
+        if pages == 0:
+            return
+        size = pages if pages < self.parallel_min_pages else self.pages_per_task
+        in_flight = deque()
+        for start in range(1, pages + 1, size):
+            in_flight.append(pool.apply_async(pdf_extract.extract_page_range, (path, start, min(start + size, pages + 1))))
+            if len(in_flight) >= self.processes * 2:
+                yield from wait(in_flight.popleft())
+        while in_flight:
+            yield from wait(in_flight.popleft())
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and self._pid == os.getpid():
+            pool.terminate()
+
+    def _get_pool(self):
+        pid = os.getpid()
+        with self._lock:
+            if self._pool is None or self._pid != pid:
+                # A pool inherited through fork belongs to the parent; start our own
+                context = multiprocessing.get_context(self.start_method)
+                self._pool = context.Pool(self.processes, maxtasksperchild=200)
+                self._pid = pid
+            return self._pool
+
+    def _discard_pool(self, pool):
+        # Stuck tasks cannot be cancelled individually; replace the whole pool.
+        # Other documents extracting on it fail too and are retried by their jobs.
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.terminate()
+
+pdf_extractor = PDFExtractor(processes=PDF_EXTRACT_PROCESSES, parallel_min_pages=PDF_PARALLEL_MIN_PAGES,
+                             pages_per_task=PDF_PAGES_PER_TASK, timeout=PDF_EXTRACT_TIMEOUT,
+                             start_method=PDF_EXTRACT_START_METHOD)
+atexit.register(pdf_extractor.shutdown)
 
 def extract_text_from_pdf(file_stream):
     try:
-        pdf_reader = PyPDF2.PdfReader(file_stream)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() or ""
-        return text
+        return "\n".join(text for _, text in iter_pdf_pages(file_stream))
     except Exception as e:
         print(f"Error extracting text from PDF: {e}")
         return ""
 
-def chunk_text(text, max_tokens=500):
-    # This is a simple chunking strategy; more advanced ones exist
-    words = text.split()
-    chunks = []
+def chunk_pages(pages, max_tokens=500):
+    """Word-window chunks over a stream of (page_number, text). Yields (chunk, first_page, last_page).
+
+    Only the words of the chunk being built are held, so a document of any
+    length streams through in constant memory.
+    """
     current_chunk = []
-    for word in words:
-        current_chunk.append(word)
-        if len(current_chunk) >= max_tokens:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = []
+    first_page = last_page = None
+    for number, text in pages:
+        for word in text.split():
+            if not current_chunk:
+                first_page = number
+            current_chunk.append(word)
+            last_page = number
+            if len(current_chunk) >= max_tokens:
+                yield " ".join(current_chunk), first_page, last_page
+                current_chunk = []
     if current_chunk:
-        chunks.append(" ".join(current_chunk))
-    return chunks
+        yield " ".join(current_chunk), first_page, last_page
 
-def summarize_with_gpt(text_chunk):
-    """Generate summary for a text chunk"""
-    try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+def chunk_text(text, max_tokens=500):
+    # This is a simple chunking strategy; more advanced ones exist
+    return [chunk for chunk, _, _ in chunk_pages([(1, text)], max_tokens)]
+
+# --- TOKEN-AWARE CHUNKING ---
+_tokenizer = {"loaded": False, "encoding": None}
+_tokenizer_lock = threading.Lock()
+
+def get_tokenizer():
+    """The tiktoken encoding for TOKENIZER_ENCODING, or None when it cannot be loaded.
+
+    tiktoken fetches its BPE ranks on first use, so an offline host without a
+    warm TIKTOKEN_CACHE_DIR falls back to estimate_tokens() with a warning.
+    """
+    if not _tokenizer["loaded"]:
+        with _tokenizer_lock:
+            if not _tokenizer["loaded"]:
+                try:
+                    import tiktoken
+                    _tokenizer["encoding"] = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                except Exception as e:
+                    app.logger.warning(f"Tokenizer {TOKENIZER_ENCODING} unavailable, estimating token counts: {str(e)}")
+                _tokenizer["loaded"] = True
+    return _tokenizer["encoding"]
+
+def count_tokens(text):
+    encoding = get_tokenizer()
+    return len(encoding.encode(text, disallowed_special=())) if encoding else estimate_tokens(text)
+
+# A unit ends after . ! ? or ; followed by something that can open a sentence or a clause like (b)
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?;])\s+(?=[(\["\'\u201c\u2018]?[A-Z0-9]|\([a-z]{1,4}\)\s)')
+# Headings that open a new structural section of a regulation
+_SECTION_START_RE = re.compile(r'(?:ARTICLE|Article|SECTION|Section|CHAPTER|Chapter|PART|Part|SCHEDULE|Schedule|ANNEX|Annex|REGULATION|Regulation)\s+(?:\d+[A-Za-z]?|[IVXLC]+)\b')
+
+class TokenChunker:
+    """Packs sentences into chunks of at most `max_tokens` real tokens.
+
+    Input is a stream of (page_number, text). Text is cut into sentence and
+    clause units, carrying an unfinished sentence over to the next page, and
+    units are packed greedily into chunks. Consecutive chunks share up to
+    `overlap_tokens` of trailing sentences. A unit that opens an Article,
+    Section, Chapter and so on starts a fresh chunk, with no overlap, once the
+    current one holds `min_section_tokens`. A single unit longer than
+    `max_tokens` is cut on token boundaries. Yields (chunk, first_page,
+    last_page) like chunk_pages(), holding only the chunk being built.
+    """
+
+    def __init__(self, max_tokens=400, overlap_tokens=50, min_section_tokens=100, max_pending_chars=20000):
+        self.max_tokens = max_tokens
+        self.overlap_tokens = min(overlap_tokens, max_tokens // 2)
+        self.min_section_tokens = min_section_tokens
+        self.max_pending_chars = max_pending_chars
+
+    def chunk_pages(self, pages):
+        current = deque()  # units: (text, tokens, first_page, last_page)
+        total = 0
+        for text, first_page, last_page in self._units(pages):
+            tokens = count_tokens(text)
+            starts_section = bool(_SECTION_START_RE.match(text))
+            if tokens > self.max_tokens:
+                if current:
+                    yield self._emit(current)
+                    current, total = deque(), 0
+                for piece in self._split_long(text):
+                    yield piece, first_page, last_page
+                continue
+            if current and (total + tokens > self.max_tokens or (starts_section and total >= self.min_section_tokens)):
+                yield self._emit(current)
+                if starts_section:
+                    current, total = deque(), 0
+                else:
+                    current, total = self._overlap(current)
+                    while current and total + tokens > self.max_tokens:
+                        total -= current.popleft()[1]
+            current.append((text, tokens, first_page, last_page))
+            total += tokens
+        if current:
+            yield self._emit(current)
+
+    def _units(self, pages):
+        pending, pending_page = "", None
+        for number, text in pages:
+            if not text:
+                continue
+            if pending:
+                text = pending + " " + text
+            else:
+                pending_page = number
+            parts = _SENTENCE_END_RE.split(text)
+            for part in parts[:-1]:
+                yield part, pending_page, number
+                pending_page = number
+            pending = parts[-1]
+            if len(pending) > self.max_pending_chars:
+                # No sentence boundary in sight (tables, lists): don't let the carry grow unbounded
+                yield pending, pending_page, number
+                pending, pending_page = "", None
+        if pending:
+            yield pending, pending_page, number
+
+    def _overlap(self, units):
+        tail, total = deque(), 0
+        for unit in reversed(units):
+            if total + unit[1] > self.overlap_tokens:
+                break
+            tail.appendleft(unit)
+            total += unit[1]
+        return tail, total
+
+    def _split_long(self, text):
+        encoding = get_tokenizer()
+        step = self.max_tokens - self.overlap_tokens
+        if encoding is None:
+            yield from self._split_estimated(text)
+            return
+        tokens = encoding.encode(text, disallowed_special=())
+        for start in range(0, len(tokens), step):
+            yield encoding.decode(tokens[start:start + self.max_tokens]).strip()
+            if start + self.max_tokens >= len(tokens):
+                break
+
+    def _split_estimated(self, text):
+        """_split_long without a tokenizer: word pieces that estimate_tokens() keeps within max_tokens."""
+        # estimate_tokens() is len // 3 + 1, so these are the longest strings within each budget
+        max_chars = 3 * self.max_tokens - 1
+        overlap_chars = 3 * self.overlap_tokens - 1
+        words = [word[i:i + max_chars] for word in text.split() for i in range(0, len(word), max_chars)]
+        start = 0
+        while start < len(words):
+            end, length = start, -1
+            while end < len(words) and length + 1 + len(words[end]) <= max_chars:
+                length += 1 + len(words[end])
+                end += 1
+            yield " ".join(words[start:end])
+            if end >= len(words):
+                break
+            # Step back over the trailing words that fit the overlap budget, always moving forward
+            back, length = end, -1
+            while back - 1 > start and length + 1 + len(words[back - 1]) <= overlap_chars:
+                back -= 1
+                length += 1 + len(words[back])
+            start = back
+
+    @staticmethod
+    def _emit(units):
+        return " ".join(unit[0] for unit in units), units[0][2], units[-1][3]
+
+token_chunker = TokenChunker(max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS,
+                             min_section_tokens=CHUNK_MIN_SECTION_TOKENS)
+
+class TokenBucket:
+    """Thread-safe token bucket. acquire() blocks until the requested tokens are available."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)  # an oversized request waits for a full bucket, not forever
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+# Shared by every chat completion this process makes (requests/min and tokens/min)
+openai_request_limiter = TokenBucket(OPENAI_REQUESTS_PER_MINUTE)
+openai_token_limiter = TokenBucket(OPENAI_TOKENS_PER_MINUTE)
+
+def _chat_completion(system_prompt, text, max_tokens):
+    def create():
+        # Every attempt, including retries, spends from the rate limit buckets
+        openai_request_limiter.acquire()
+        openai_token_limiter.acquire(estimate_tokens(system_prompt) + estimate_tokens(text) + max_tokens)
+        return client.chat.completions.create(
+            model=SUMMARY_MODEL,
             messages=[
-                {"role": "system", "content": """
-                You are a professional advisor at Financial Regulations Center.
-                 Create a concise summary of key points from documents to make it easy for your clients to understand."""},
-                {"role": "user", "content": text_chunk[:8000]}
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": text}
             ],
-            max_tokens=150,
+            max_tokens=max_tokens,
             temperature=0.3
         )
-        return response.choices[0].message.content
-    except openai.RateLimitError:
-      #  time.sleep(60)
-        return summarize_with_gpt(text_chunk)
+    return call_with_backoff(create).choices[0].message.content
+
+def summarize_with_gpt(text_chunk):
+    """Generate summary for a text chunk"""
+    try:
+        return _chat_completion("""
+                You are a professional advisor at Financial Regulations Center.
+                 Create a concise summary of key points from documents to make it easy for your clients to understand.""",
+                                text_chunk[:8000], max_tokens=150)
     except Exception as e:
         app.logger.error(f"GPT error: {str(e)}")
         return None
 
-def generate_ai_summary(file):
-    """Main summarization function"""
+def combine_summaries(summaries, max_tokens=500):
+    return _chat_completion("Combine these into a cohesive summary:", "\n".join(summaries), max_tokens=max_tokens)
+
+def _map_concurrently(fn, items, concurrency):
+    """Apply fn to items on up to `concurrency` threads, keeping input order and a bounded number in flight."""
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= concurrency * 2:
+                results.append(pending.popleft().result())
+        while pending:
+            results.append(pending.popleft().result())
+    return results
+
+def _group_for_reduce(summaries, budget):
+    """Pack consecutive summaries into groups of at most ~budget tokens (always at least two per group)."""
+    groups, group, group_tokens = [], [], 0
+    for summary in summaries:
+        tokens = estimate_tokens(summary)
+        if len(group) >= 2 and group_tokens + tokens > budget:
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(summary)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+def generate_ai_summary(text):
+    """Main summarization function: concurrent map over the whole document, then hierarchical reduce."""
+    if not text.strip():
+        return "No extractable text found"
+    return summarize_chunks(chunk_text(text, max_tokens=SUMMARY_CHUNK_WORDS))
+
+def summarize_chunks(chunks):
+    """Summarize an iterable of SUMMARY_CHUNK_WORDS-sized text chunks, consuming it lazily."""
     try:
-        text = extract_text_from_pdf(file)
-        if not text.strip():
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        if first is None:
             return "No extractable text found"
+        chunks = itertools.chain([first], chunks)
+        if SUMMARY_MAX_CHUNKS:
+            chunks = itertools.islice(chunks, SUMMARY_MAX_CHUNKS)  # Optional cost cap; 0 covers the whole document
         
-        chunks = chunk_text(text)[:5]  # Limit to 5 chunks to control costs
-        if not chunks:
-            return "Text too short for summary"
-        
-        summaries = []
-        for i, chunk in enumerate(chunks):
-            summary = summarize_with_gpt(chunk)
-            if summary:
-                summaries.append(summary)
-           # if (i + 1) % 3 == 0:  # Rate limit handling
-            #    time.sleep(60)
-        
+        summaries = [s for s in _map_concurrently(summarize_with_gpt, chunks, SUMMARY_CONCURRENCY) if s]
         if not summaries:
             return "Could not generate summary"
-            
-        # Combine summaries
-        combined = "\n".join(summaries)
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Combine these into a cohesive summary:"},
-                {"role": "user", "content": combined}
-            ],
-            max_tokens=500,
-            temperature=0.3
-        )
-        return response.choices[0].message.content
+
+        # Reduce level by level until one combine call can take everything
+        while True:
+            groups = _group_for_reduce(summaries, SUMMARY_REDUCE_BUDGET_TOKENS)
+            if len(groups) == 1:
+                break
+            summaries = _map_concurrently(lambda group: combine_summaries(group, max_tokens=300),
+                                          groups, SUMMARY_CONCURRENCY)
+
+        return combine_summaries(summaries)
         
     except Exception as e:
         app.logger.error(f"Summary generation failed: {str(e)}")
         return "AI summary unavailable"
 
+# --- DOCUMENT INGESTION PIPELINE ---
+# Uploads are processed off the request path: create_document stores the file,
+# inserts the documents row as 'pending' and an ingestion_jobs row, and the
+# worker threads below claim jobs with FOR UPDATE SKIP LOCKED and run the stages.
+INGEST_STAGES = ("extract", "clean", "chunk", "embed", "summarize")
+
+def _update_job_progress(job_id, stage, **details):
+    """Merge details into progress[stage]. Every update also renews the job's lease."""
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE ingestion_jobs
+                SET stage = %(stage)s,
+                    progress = jsonb_set(progress, ARRAY[%(stage)s],
+                                         COALESCE(progress -> %(stage)s, '{}'::jsonb) || %(details)s::jsonb),
+                    locked_at = NOW(), updated_at = NOW()
+                WHERE job_id = %(job_id)s;
+            """, {"stage": stage, "details": json.dumps(details, default=str), "job_id": job_id})
+        conn.commit()
+
+def _start_stage(job_id, stage, **details):
+    _update_job_progress(job_id, stage, state="running", started_at=datetime.now(timezone.utc), **details)
+
+def _finish_stage(job_id, stage, **details):
+    _update_job_progress(job_id, stage, state="done", finished_at=datetime.now(timezone.utc), **details)
+
+@contextmanager
+def renewing_job_lease(job_id, interval=None):
+    """Renew a job's lease from a background thread, for stages (summarize) with no progress updates of their own."""
+    interval = interval or max(1.0, INGEST_LOCK_TIMEOUT / 3)
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(interval):
+            try:
+                with db_connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute("UPDATE ingestion_jobs SET locked_at = NOW(), updated_at = NOW() "
+                                    "WHERE job_id = %s AND status = 'running';", (job_id,))
+                    conn.commit()
+            except Exception as e:
+                app.logger.warning(f"Could not renew the lease of ingestion job {job_id}: {str(e)}")
+
+    thread = threading.Thread(target=renew, name=f"ingest-lease-{job_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def claim_ingestion_job(worker_id):
+    """Claim the oldest runnable job, or a running one whose lease expired. Returns (job_id, document_id, attempts) or None."""
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            # A worker that died on a job's last attempt leaves nothing to retry: fail the job and its document
+            cur.execute("""
+                WITH expired AS (
+                    UPDATE ingestion_jobs
+                    SET status = 'failed', error = 'Worker stopped responding during the final attempt.',
+                        locked_by = NULL, locked_at = NULL, updated_at = NOW(), finished_at = NOW()
+                    WHERE status = 'running' AND locked_at < NOW() - %s * INTERVAL '1 second' AND attempts >= %s
+                    RETURNING document_id
+                )
+                UPDATE documents SET status = 'failed' WHERE documentid IN (SELECT document_id FROM expired);
+            """, (INGEST_LOCK_TIMEOUT, INGEST_MAX_ATTEMPTS))
+            cur.execute("""
+                UPDATE ingestion_jobs
+                SET status = 'running', attempts = attempts + 1, error = NULL,
+                    locked_by = %s, locked_at = NOW(), updated_at = NOW()
+                WHERE job_id = (
+                    SELECT job_id FROM ingestion_jobs
+                    WHERE (status = 'pending' AND run_after <= NOW())
+                       OR (status = 'running' AND locked_at < NOW() - %s * INTERVAL '1 second' AND attempts < %s)
+                    ORDER BY created_at
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING job_id, document_id, attempts;
+            """, (worker_id, INGEST_LOCK_TIMEOUT, INGEST_MAX_ATTEMPTS))
+            job = cur.fetchone()
+        conn.commit()
+    return job
+
+def _fail_ingestion_job(job_id, document_id, attempts, error):
+    final = attempts >= INGEST_MAX_ATTEMPTS
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE ingestion_jobs
+                SET status = %s, error = %s, locked_by = NULL, locked_at = NULL, updated_at = NOW(),
+                    run_after = NOW() + %s * INTERVAL '1 minute',
+                    finished_at = CASE WHEN %s THEN NOW() END
+                WHERE job_id = %s;
+            """, ('failed' if final else 'pending', error, attempts, final, job_id))
+            if final:
+                cur.execute("UPDATE documents SET status = 'failed' WHERE documentid = %s;", (document_id,))
+        conn.commit()
+
+def insert_document_chunks(cur, document, chunks, embeddings, model_id):
+    """Bulk-insert (text, first_page, last_page) chunks, copying the document's search filter columns onto every row."""
+    if not chunks:
+        return
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO document_chunks (document_id, chunk_text, page_start, page_end, embedding,
+                                     embedding_model, embedding_dim,
+                                     regulator_id, type_id, is_archived, service_ids)
+        VALUES %s;
+        """,
+        [(document["document_id"], chunk, page_start, page_end, embedding,
+          model_id, len(embedding), document["regulator_id"],
+          document["type_id"], document["is_archived"], document["service_ids"])
+         for (chunk, page_start, page_end), embedding in zip(chunks, embeddings)],
+        page_size=500
+    )
+
+def sync_chunk_filters(cur, document_id):
+    """Re-copy a document's filter columns (archived flag, regulator, type, services) onto its chunks."""
+    cur.execute("""
+        UPDATE document_chunks dc
+        SET regulator_id = d.regulatorid, type_id = d.typeid, is_archived = d.is_archived,
+            service_ids = ARRAY(SELECT serviceid FROM document_services WHERE documentid = d.documentid ORDER BY serviceid)
+        FROM documents d
+        WHERE d.documentid = dc.document_id AND dc.document_id = %s;
+    """, (document_id,))
+
+def find_ingested_duplicate(document_id, content_sha256):
+    """Id of an already-ingested document with the same file content, embedded by the current model, or None."""
+    if not content_sha256:
+        return None
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT d.documentid FROM documents d
+                WHERE d.content_sha256 = %s AND d.documentid <> %s AND d.status = 'ready'
+                  AND NOT EXISTS (SELECT 1 FROM document_chunks dc
+                                  WHERE dc.document_id = d.documentid AND dc.embedding_model IS DISTINCT FROM %s)
+                ORDER BY d.documentid LIMIT 1;
+            """, (content_sha256, document_id, active_embedding_provider().model_id))
+            row = cur.fetchone()
+    return row[0] if row else None
+
+def reuse_duplicate_ingestion(job_id, document, source_id):
+    """Finish a job by copying chunks, embeddings and summary from an identical document; no OpenAI calls."""
+    _start_stage(job_id, "embed", reused_from=source_id)
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM document_chunks WHERE document_id = %s;", (document["document_id"],))
+            cur.execute("""
+                INSERT INTO document_chunks (document_id, chunk_text, page_start, page_end, embedding,
+                                             embedding_model, embedding_dim,
+                                             regulator_id, type_id, is_archived, service_ids)
+                SELECT %s, chunk_text, page_start, page_end, embedding, embedding_model, embedding_dim, %s, %s, %s, %s
+                FROM document_chunks WHERE document_id = %s
+                ORDER BY id;
+            """, (document["document_id"], document["regulator_id"], document["type_id"],
+                  document["is_archived"], document["service_ids"], source_id))
+            copied = cur.rowcount
+            cur.execute("""
+                UPDATE documents d SET summary_ai = src.summary_ai, status = 'ready'
+                FROM documents src
+                WHERE d.documentid = %s AND src.documentid = %s;
+            """, (document["document_id"], source_id))
+        conn.commit()
+    _finish_stage(job_id, "embed", done=copied, total=copied)
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE ingestion_jobs
+                SET status = 'done', locked_by = NULL, locked_at = NULL, updated_at = NOW(), finished_at = NOW()
+                WHERE job_id = %s;
+            """, (job_id,))
+        conn.commit()
+    cache_versions.bump('corpus')
+    log_system_action("document_ingested", target_type="document", target_id=document["document_id"],
+                      details={"job_id": job_id, "reused_from": source_id})
+
+def _spooled_batches(spool):
+    """Read back the (chunks, embeddings) batches pickled into a spool file, in order."""
+    while True:
+        try:
+            yield pickle.load(spool)
+        except EOFError:
+            return
+
+def run_ingestion_job(job_id, document_id, attempts):
+    """extract -> clean -> chunk -> embed -> summarize for one uploaded document."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT d.fileurl, d.regulatorid, d.typeid, d.is_archived,
+                           ARRAY(SELECT serviceid FROM document_services WHERE documentid = d.documentid ORDER BY serviceid),
+                           d.content_sha256
+                    FROM documents d WHERE d.documentid = %s;
+                """, (document_id,))
+                row = cur.fetchone()
+        if row is None:
+            raise Exception(f"Document {document_id} no longer exists.")
+        file_path = row[0]
+        document = {"document_id": document_id, "regulator_id": row[1], "type_id": row[2],
+                    "is_archived": row[3], "service_ids": row[4]}
+
+        source_id = find_ingested_duplicate(document_id, row[5])
+        if source_id is not None:
+            reuse_duplicate_ingestion(job_id, document, source_id)
+            return
+
+        # extract -> clean -> chunk -> embed run as one streaming pass over the
+        # pages, so the file is read once and only a batch of chunks is in memory
+        for stage in ("extract", "clean", "chunk", "embed"):
+            _start_stage(job_id, stage)
+        progress = {"pages": 0, "characters": 0, "chunks": 0}
+        # Cleaned text is also spooled to a temp file for the summary, whose
+        # windows are larger than the (overlapping) embedding chunks
+        spool = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+        # Embedded batches wait in a second spool, so no connection is held while the model works
+        chunk_spool = tempfile.TemporaryFile()
+
+        def cleaned_pages():
+            pages = pdf_extractor.iter_pages(file_path) if file_path.lower().endswith('.pdf') else iter(())
+            for number, text in pages:
+                progress["pages"] = number
+                progress["characters"] += len(text)
+                text = clean_text(text)
+                spool.write(text + "\n")
+                yield number, text
+
+        with spool, chunk_spool:
+            provider = active_embedding_provider()
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    check_embedding_dimension(cur, provider)
+            chunk_stream = token_chunker.chunk_pages(cleaned_pages())
+            while True:
+                batch = list(itertools.islice(chunk_stream, EMBEDDING_BATCH_SIZE))
+                if not batch:
+                    break
+                embeddings = get_embeddings([chunk for chunk, _, _ in batch], provider=provider)
+                pickle.dump((batch, embeddings), chunk_spool, protocol=pickle.HIGHEST_PROTOCOL)
+                progress["chunks"] += len(batch)
+                _update_job_progress(job_id, "embed", done=progress["chunks"], pages=progress["pages"])
+
+            # One short transaction swaps the document's chunks: a retried job replaces whatever
+            # an earlier attempt wrote, and search never sees half a document
+            chunk_spool.seek(0)
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    if locked_embedding_provider(cur) is not provider:
+                        raise Exception("The embedding model was switched during ingestion; the job will be retried.")
+                    cur.execute("DELETE FROM document_chunks WHERE document_id = %s;", (document_id,))
+                    for batch, embeddings in _spooled_batches(chunk_spool):
+                        insert_document_chunks(cur, document, batch, embeddings, provider.model_id)
+                conn.commit()
+            cache_versions.bump('corpus')
+            _finish_stage(job_id, "extract", pages=progress["pages"], characters=progress["characters"])
+            _finish_stage(job_id, "clean")
+            _finish_stage(job_id, "chunk", chunks=progress["chunks"])
+            _finish_stage(job_id, "embed", total=progress["chunks"])
+
+            _start_stage(job_id, "summarize")
+            spool.seek(0)
+            summary_windows = chunk_pages(((0, line) for line in spool), SUMMARY_CHUNK_WORDS)
+            with renewing_job_lease(job_id):
+                ai_summary = summarize_chunks(chunk for chunk, _, _ in summary_windows)
+            _finish_stage(job_id, "summarize")
+
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE documents SET summary_ai = %s, status = 'ready' WHERE documentid = %s;",
+                            (ai_summary, document_id))
+                cur.execute("""
+                    UPDATE ingestion_jobs
+                    SET status = 'done', locked_by = NULL, locked_at = NULL, updated_at = NOW(), finished_at = NOW()
+                    WHERE job_id = %s;
+                """, (job_id,))
+            conn.commit()
+        cache_versions.bump('corpus')
+        log_system_action("document_ingested", target_type="document", target_id=document_id, details={"job_id": job_id})
+    except Exception as e:
+        app.logger.error(f"Ingestion job {job_id} failed (attempt {attempts}): {str(e)}")
+        try:
+            _fail_ingestion_job(job_id, document_id, attempts, str(e))
+        except Exception as db_error:
+            app.logger.error(f"Could not record failure of ingestion job {job_id}: {str(db_error)}")
+
+class IngestionWorkerPool:
+    """Threads in each worker process that poll ingestion_jobs; wake() skips the poll delay after an upload."""
+
+    def __init__(self, workers=2, poll_interval=5.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+
+    def ensure_started(self):
+        pid = os.getpid()
+        if self.workers <= 0 or self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self._wakeup = threading.Event()
+            self._threads = [
+                threading.Thread(target=self._run, name=f"ingest-worker-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+        while not self._stop.is_set():
+            try:
+                job = claim_ingestion_job(worker_id)
+            except Exception as e:
+                app.logger.error(f"Could not claim ingestion job: {str(e)}")
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            run_ingestion_job(*job)
+
+ingestion_workers = IngestionWorkerPool(workers=INGEST_WORKERS, poll_interval=INGEST_POLL_INTERVAL)
+
+# --- RE-EMBEDDING ---
+
+# Live column -> shadow column filled with the target model's vectors
+REEMBED_SHADOW_COLUMNS = {"embedding": "embedding_next", "embedding_model": "embedding_next_model",
+                          "embedding_dim": "embedding_next_dim"}
+REEMBED_LOCK_KEY = 72410  # session advisory lock held by whichever process runs the job
+_LOCK_NOT_AVAILABLE = "55P03"
+
+def unfinished_reembed_job(cur):
+    cur.execute("""
+        SELECT job_id, model_id, dimension, phase, status, last_chunk_id, chunks_done, chunks_total, error
+        FROM reembed_jobs WHERE finished_at IS NULL;
+    """)
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return dict(zip(("job_id", "model_id", "dimension", "phase", "status", "last_chunk_id",
+                     "chunks_done", "chunks_total", "error"), row))
+
+def shadow_index_name(name):
+    return f"{name[:58]}_next"
+
+class Reembedder:
+    """Moves document_chunks to another embedding model while search stays online.
+
+    1. backfill: walk the chunks in id order (keyset batches), embed each batch
+       with the target provider and write it to the shadow columns, committing
+       it together with the job's checkpoint; a restarted job resumes after the
+       last committed id.
+    2. catchup: walk again for rows still without a shadow vector (chunks whose
+       ingestion transaction committed behind the checkpoint).
+    3. index: build a copy of every ANN index on the shadow column, CONCURRENTLY.
+    4. cutover: one transaction that blocks ingestion writes, embeds the last
+       stragglers, swaps the columns and indexes and records the model in
+       embedding_state.
+
+    Search reads only the live column and its indexes until the cutover commits.
+    """
+
+    def __init__(self, batch_size=500, tokens_per_minute=500000, requests_per_minute=200,
+                 lock_timeout="5s", cutover_attempts=20, echo=print):
+        self.batch_size = batch_size
+        self.lock_timeout = lock_timeout
+        self.cutover_attempts = cutover_attempts
+        self.echo = echo
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._requests = TokenBucket(requests_per_minute)
+
+    def run(self, provider=None, cutover=True, maintenance_work_mem="1GB"):
+        """Start a job towards `provider`, or resume the unfinished one. Returns the job_id."""
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s);", (REEMBED_LOCK_KEY,))
+                locked = cur.fetchone()[0]
+            conn.commit()
+            if not locked:
+                raise RuntimeError("Another process is already running the re-embedding job.")
+            job = None
+            try:
+                job, provider = self._claim(conn, provider)
+                if job["phase"] == "backfill":
+                    self._walk(conn, job, provider, after=job["last_chunk_id"])
+                    self._set_phase(conn, job, "catchup")
+                if job["phase"] == "catchup":
+                    self._walk(conn, job, provider, after=0)
+                    self._set_phase(conn, job, "index")
+                if job["phase"] == "index":
+                    self._build_indexes(conn, job, maintenance_work_mem)
+                    self._set_phase(conn, job, "cutover")
+                if cutover:
+                    self._cutover(conn, job, provider)
+                else:
+                    self.echo(f"Job {job['job_id']} is ready; run `flask reembed` again to cut over.")
+                return job["job_id"]
+            except Exception as e:
+                conn.rollback()
+                if job is not None:
+                    with conn.cursor() as cur:
+                        cur.execute("UPDATE reembed_jobs SET status = 'failed', error = %s, updated_at = NOW() "
+                                    "WHERE job_id = %s;", (str(e), job["job_id"]))
+                    conn.commit()
+                raise
+            finally:
+                conn.autocommit = False
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s);", (REEMBED_LOCK_KEY,))
+                conn.commit()
+
+    def _claim(self, conn, provider):
+        with conn.cursor() as cur:
+            job = unfinished_reembed_job(cur)
+            if job is not None:
+                if provider is not None and provider.model_id != job["model_id"]:
+                    raise ValueError(f"Job {job['job_id']} is re-embedding with {job['model_id']}; "
+                                     "let it finish or run `flask reembed-cancel` first.")
+                provider = embedding_provider_for(job["model_id"])
+                cur.execute("UPDATE reembed_jobs SET status = 'running', error = NULL, updated_at = NOW() "
+                            "WHERE job_id = %s;", (job["job_id"],))
+                conn.commit()
+                self.echo(f"Resuming job {job['job_id']} ({job['model_id']}) at {job['phase']}, "
+                          f"after chunk {job['last_chunk_id']}.")
+                return job, provider
+            if provider is None:
+                raise ValueError("No re-embedding job to resume; choose a target model.")
+            # Compare against what the chunks hold, not against what the environment configures
+            current = read_embedding_state(cur)
+            if current is None:
+                raise ValueError("document_chunks is empty; set ATAS_EMBEDDING_PROVIDER instead of re-embedding.")
+            if provider.model_id == current:
+                raise ValueError(f"document_chunks is already embedded with {provider.model_id}.")
+            conn.commit()
+
+            dimension = provider.dimension
+            cur.execute("SET LOCAL lock_timeout = %s;", (self.lock_timeout,))
+            # Leftovers of a cancelled job are dropped; adding nullable columns does not rewrite the table
+            cur.execute("ALTER TABLE document_chunks " + ", ".join(
+                f"DROP COLUMN IF EXISTS {shadow}" for shadow in REEMBED_SHADOW_COLUMNS.values()) + ";")
+            cur.execute(f"""
+                ALTER TABLE document_chunks
+                    ADD COLUMN embedding_next vector({int(dimension)}),
+                    ADD COLUMN embedding_next_model TEXT,
+                    ADD COLUMN embedding_next_dim INTEGER;
+            """)
+            cur.execute("SELECT COUNT(*) FROM document_chunks;")
+            total = cur.fetchone()[0]
+            cur.execute("""
+                INSERT INTO reembed_jobs (model_id, previous_model_id, dimension, chunks_total)
+                VALUES (%s, %s, %s, %s) RETURNING job_id;
+            """, (provider.model_id, current, dimension, total))
+            job_id = cur.fetchone()[0]
+        conn.commit()
+        self.echo(f"Started job {job_id}: {current} -> {provider.model_id} ({dimension}d), {total} chunks.")
+        return {"job_id": job_id, "model_id": provider.model_id, "dimension": dimension, "phase": "backfill",
+                "last_chunk_id": 0, "chunks_done": 0, "chunks_total": total}, provider
+
+    def _set_phase(self, conn, job, phase):
+        with conn.cursor() as cur:
+            # Recount, since chunks were ingested and deleted while the previous phase ran
+            cur.execute("SELECT COUNT(*), COUNT(embedding_next) FROM document_chunks;")
+            total, done = cur.fetchone()
+            cur.execute("""
+                UPDATE reembed_jobs
+                SET phase = %s, last_chunk_id = 0, chunks_total = %s, chunks_done = %s, updated_at = NOW()
+                WHERE job_id = %s;
+            """, (phase, total, done, job["job_id"]))
+        conn.commit()
+        job.update(phase=phase, last_chunk_id=0, chunks_total=total, chunks_done=done)
+
+    def _throttle(self, provider, texts):
+        self._tokens.acquire(sum(estimate_tokens(text) for text in texts))
+        if provider.name == "openai":
+            self._requests.acquire(math.ceil(len(texts) / provider.batch_size))
+
+    def _write_shadow(self, cur, ids, vectors, provider):
+        """Store one batch (at most batch_size rows, so a single UPDATE); returns the rows actually filled."""
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            UPDATE document_chunks AS dc
+            SET embedding_next = v.embedding, embedding_next_model = v.model, embedding_next_dim = v.dim
+            FROM (VALUES %s) AS v(id, embedding, model, dim)
+            WHERE dc.id = v.id;
+            """,
+            [(chunk_id, vector, provider.model_id, len(vector)) for chunk_id, vector in zip(ids, vectors)],
+            template="(%s::bigint, %s::vector, %s::text, %s::integer)",
+            page_size=self.batch_size
+        )
+        return cur.rowcount
+
+    def _walk(self, conn, job, provider, after):
+        """Embed every chunk past `after` that has no shadow vector yet, one checkpointed batch at a time."""
+        last_id = after
+        while True:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, chunk_text FROM document_chunks
+                    WHERE id > %s AND embedding_next IS NULL
+                    ORDER BY id LIMIT %s;
+                """, (last_id, self.batch_size))
+                rows = cur.fetchall()
+            conn.commit()  # don't sit in a transaction (and on a snapshot) while the model works
+            if not rows:
+                return
+            texts = [text for _, text in rows]
+            self._throttle(provider, texts)
+            vectors = provider.embed(texts)
+            last_id = rows[-1][0]
+            with conn.cursor() as cur:
+                # Chunks deleted since the SELECT are not counted; ones ingested since the job started grow the total
+                filled = self._write_shadow(cur, [chunk_id for chunk_id, _ in rows], vectors, provider)
+                cur.execute("""
+                    UPDATE reembed_jobs
+                    SET last_chunk_id = %(last_id)s, chunks_done = chunks_done + %(filled)s,
+                        chunks_total = GREATEST(chunks_total, chunks_done + %(filled)s), updated_at = NOW()
+                    WHERE job_id = %(job_id)s RETURNING chunks_done, chunks_total;
+                """, {"last_id": last_id, "filled": filled, "job_id": job["job_id"]})
+                job["chunks_done"], job["chunks_total"] = cur.fetchone()
+            conn.commit()
+            job["last_chunk_id"] = last_id
+            self.echo(f"{job['phase']}: {job['chunks_done']}/{job['chunks_total'] or '?'} chunks (last id {last_id})")
+
+    def _build_indexes(self, conn, job, maintenance_work_mem):
+        """CREATE INDEX CONCURRENTLY a shadow twin of every ANN index on the live column."""
+        with conn.cursor() as cur:
+            live = vector_indexes_on(cur, "embedding")
+        conn.commit()
+        conn.autocommit = True  # CREATE INDEX CONCURRENTLY cannot run in a transaction
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET maintenance_work_mem = %s;", (maintenance_work_mem,))
+                for name, definition in live:
+                    shadow = shadow_index_name(name)
+                    # An interrupted concurrent build leaves an INVALID index that IF NOT EXISTS would keep
+                    cur.execute("""
+                        SELECT NOT x.indisvalid FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+                        WHERE i.relname = %s;
+                    """, (shadow,))
+                    row = cur.fetchone()
+                    if row and row[0]:
+                        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {shadow};")
+                    ddl = re.sub(r"^CREATE INDEX \S+ ON ", f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {shadow} ON ", definition)
+                    ddl = re.sub(r"\bembedding\b", "embedding_next", ddl)
+                    # Compact (halfvec / binary) index expressions carry the dimension
+                    ddl = re.sub(r"::(halfvec|bit)\(\d+\)", rf"::\1({int(job['dimension'])})", ddl)
+                    started = time.perf_counter()
+                    cur.execute(ddl)
+                    self.echo(f"Built {shadow} in {time.perf_counter() - started:.1f}s")
+                cur.execute("RESET maintenance_work_mem;")
+        finally:
+            conn.autocommit = False
+
+    def _cutover(self, conn, job, provider):
+        for attempt in range(1, self.cutover_attempts + 1):
+            # Keep the set of chunks left to embed under the lock small
+            self._walk(conn, job, provider, after=0)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SET LOCAL lock_timeout = %s;", (self.lock_timeout,))
+                    # Blocks ingestion writes, not searches, while the last stragglers are embedded
+                    cur.execute("LOCK TABLE document_chunks IN SHARE ROW EXCLUSIVE MODE;")
+                    cur.execute("SELECT id, chunk_text FROM document_chunks WHERE embedding_next IS NULL ORDER BY id;")
+                    stragglers = cur.fetchall()
+                    filled = 0
+                    for start in range(0, len(stragglers), self.batch_size):
+                        batch = stragglers[start:start + self.batch_size]
+                        vectors = provider.embed([text for _, text in batch])
+                        filled += self._write_shadow(cur, [chunk_id for chunk_id, _ in batch], vectors, provider)
+                    shadow_indexes = [name for name, _ in vector_indexes_on(cur, "embedding_next")]
+                    # From here to COMMIT the table is ACCESS EXCLUSIVE; every statement is catalog-only.
+                    # Dropping the old columns drops their indexes too.
+                    cur.execute("ALTER TABLE document_chunks " + ", ".join(
+                        f"DROP COLUMN {live}" for live in REEMBED_SHADOW_COLUMNS) + ";")
+                    for live, shadow in REEMBED_SHADOW_COLUMNS.items():
+                        cur.execute(f"ALTER TABLE document_chunks RENAME COLUMN {shadow} TO {live};")
+                    for shadow in shadow_indexes:
+                        if shadow.endswith("_next"):
+                            cur.execute(f"ALTER INDEX {shadow} RENAME TO {shadow[:-len('_next')]};")
+                    cur.execute("""
+                        INSERT INTO embedding_state (model_id, dimension, switched_at) VALUES (%s, %s, NOW())
+                        ON CONFLICT (singleton) DO UPDATE
+                        SET model_id = EXCLUDED.model_id, dimension = EXCLUDED.dimension, switched_at = NOW();
+                    """, (provider.model_id, job["dimension"]))
+                    cur.execute("""
+                        UPDATE reembed_jobs
+                        SET status = 'done', chunks_done = chunks_done + %(filled)s,
+                            chunks_total = GREATEST(chunks_total, chunks_done + %(filled)s),
+                            updated_at = NOW(), finished_at = NOW()
+                        WHERE job_id = %(job_id)s;
+                    """, {"filled": filled, "job_id": job["job_id"]})
+                conn.commit()
+            except psycopg2.OperationalError as e:
+                conn.rollback()
+                if e.pgcode != _LOCK_NOT_AVAILABLE or attempt == self.cutover_attempts:
+                    raise
+                self.echo(f"Cutover attempt {attempt}: document_chunks is busy, retrying.")
+                time.sleep(min(30, 2 ** attempt))
+                continue
+            cache_versions.bump('embedding')
+            cache_versions.bump('corpus')
+            log_system_action("corpus_reembedded", target_type="document_chunks",
+                              details={"job_id": job["job_id"], "model_id": provider.model_id})
+            self.echo(f"Cut over to {provider.model_id}; {len(stragglers)} chunk(s) embedded under the lock.")
+            return
+
+    def cancel(self):
+        """Abandon the unfinished job and drop its shadow columns (and with them the shadow indexes)."""
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s);", (REEMBED_LOCK_KEY,))
+                if not cur.fetchone()[0]:
+                    raise RuntimeError("The re-embedding job is running; stop it before cancelling.")
+                try:
+                    job = unfinished_reembed_job(cur)
+                    if job is None:
+                        return None
+                    cur.execute("SET LOCAL lock_timeout = %s;", (self.lock_timeout,))
+                    cur.execute("ALTER TABLE document_chunks " + ", ".join(
+                        f"DROP COLUMN IF EXISTS {shadow}" for shadow in REEMBED_SHADOW_COLUMNS.values()) + ";")
+                    cur.execute("UPDATE reembed_jobs SET status = 'cancelled', updated_at = NOW(), finished_at = NOW() "
+                                "WHERE job_id = %s;", (job["job_id"],))
+                    conn.commit()
+                    return job["job_id"]
+                finally:
+                    conn.rollback()
+                    cur.execute("SELECT pg_advisory_unlock(%s);", (REEMBED_LOCK_KEY,))
+                    conn.commit()
+
+reembedder = Reembedder(batch_size=REEMBED_BATCH_SIZE, tokens_per_minute=REEMBED_TOKENS_PER_MINUTE,
+                        requests_per_minute=REEMBED_REQUESTS_PER_MINUTE, lock_timeout=REEMBED_LOCK_TIMEOUT)
+
 # === PUBLIC-FACING API ENDPOINTS ===
 
 #@app.route("/", methods=['GET'])
@@ -362,6 +2758,7 @@ def create_financial_service():
         cur.execute("INSERT INTO financial_services (servicename, description) VALUES (%s, %s) RETURNING serviceid;", (serviceName, description))
         new_id = cur.fetchone()[0]        
         conn.commit()
+        reference_cache.invalidate("financial_services")
         cur.close()
         return jsonify({"success": True, "new_financial_service": {"serviceID": new_id, "serviceName": serviceName}}), 201
     except (Exception, psycopg2.DatabaseError) as error:
@@ -385,6 +2782,7 @@ def update_financial_service(service_id):
         cur = conn.cursor()
         cur.execute("UPDATE financial_services SET servicename = %s WHERE serviceid = %s;", (serviceName, service_id))
         conn.commit()
+        reference_cache.invalidate("financial_services")
         cur.close()
         return jsonify({"success": True, "message": "Financial service updated."})
     except Exception as e:
@@ -401,6 +2799,7 @@ def delete_financial_service(service_id):
         cur = conn.cursor()
         cur.execute("DELETE FROM financial_services WHERE serviceid = %s;", (service_id,))
         conn.commit()
+        reference_cache.invalidate("financial_services")
         cur.close()
         return jsonify({"success": True})
     except psycopg2.IntegrityError:
@@ -414,19 +2813,15 @@ def delete_financial_service(service_id):
 
 @app.route("/api/financial-services", methods=['GET'])
 def get_financial_services():
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT serviceid AS id, servicename AS name, description FROM financial_services ORDER BY servicename;")
-        data = cur.fetchall()
-        data_list = [{"id": row[0], "name": row[1], "description": row[2]} for row in data]
-        return jsonify(data_list)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        if conn: conn.close()
-    pass
+    return reference_data_response("financial_services")
+
+# Most recent ingestion job of the document aliased d, for LEFT JOIN LATERAL
+LATEST_INGESTION_JOB_SQL = "SELECT job_id FROM ingestion_jobs WHERE document_id = d.documentid ORDER BY job_id DESC LIMIT 1"
+
+def document_status_fields(status, job_id):
+    """Listing fields that tell a document still being processed (or failed) apart from one without a summary."""
+    return {"status": status, "jobID": job_id,
+            "statusURL": f"/api/ingestion-jobs/{job_id}" if job_id is not None else None}
 
 @app.route("/api/documents/<int:service_id>", methods=['GET'])
 def get_documents_by_service(service_id):
@@ -435,16 +2830,19 @@ def get_documents_by_service(service_id):
         conn = get_db_connection()
         cur = conn.cursor()
         sql = """
-            SELECT d.documentid, d.title, dt.typename, r.name as regulatorname, d.summary_ai
+            SELECT d.documentid, d.title, dt.typename, r.name as regulatorname, d.summary_ai, d.status, j.job_id
             FROM documents d
             JOIN document_types dt ON d.typeid = dt.typeid
             JOIN regulators r ON d.regulatorid = r.regulatorid
             JOIN document_services ds ON d.documentid = ds.documentid
-            WHERE ds.serviceid = %s ORDER BY dt.typename, d.title;
-        """
+            LEFT JOIN LATERAL (%s) j ON TRUE
+            WHERE ds.serviceid = %%s ORDER BY dt.typename, d.title;
+        """ % LATEST_INGESTION_JOB_SQL
         cur.execute(sql, (service_id,))
         data = cur.fetchall()
-        data_list = [{"documentID": row[0], "title": row[1], "typeName": row[2], "regulatorName": row[3], "summary": row[4]} for row in data]
+        # A NULL summary is only final for 'ready' documents; pending/processing ones link to their job
+        data_list = [{"documentID": row[0], "title": row[1], "typeName": row[2], "regulatorName": row[3], "summary": row[4],
+                      **document_status_fields(row[5], row[6])} for row in data]
         return jsonify(data_list)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -452,55 +2850,219 @@ def get_documents_by_service(service_id):
         if conn: conn.close()
     pass
 
+def file_fingerprint(path, block_size=1 << 20):
+    """(sha256 hex digest, size, modified time) of a stored file; the digest is the download ETag."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    stat = os.stat(path)
+    return digest.hexdigest(), stat.st_size, datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+
+def store_upload(file_storage, block_size=1 << 20):
+    """Stream an upload to UPLOAD_FOLDER/<aa>/<sha256><ext>, hashing it on the way.
+
+    Identical content always maps to the same path, so a repeat upload keeps
+    the existing file instead of writing a second copy (or overwriting a
+    different file that happened to share its name). Returns
+    (path, sha256 hex digest, size, modified time).
+    """
+    extension = os.path.splitext(secure_filename(file_storage.filename))[1].lower()
+    folder = app.config['UPLOAD_FOLDER']
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for block in iter(lambda: file_storage.stream.read(block_size), b''):
+                digest.update(block)
+                out.write(block)
+                size += len(block)
+        content_sha256 = digest.hexdigest()
+        final_dir = os.path.join(folder, content_sha256[:2])
+        os.makedirs(final_dir, exist_ok=True)
+        final_path = os.path.join(final_dir, content_sha256 + extension)
+        if os.path.exists(final_path):
+            os.remove(temp_path)
+        else:
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, final_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    modified = datetime.fromtimestamp(int(os.stat(final_path).st_mtime), timezone.utc)
+    return final_path, content_sha256, size, modified
+
 @app.route("/api/download/<int:document_id>", methods=['GET'])
 def download_document(document_id):
+    """Sends a document file with a strong ETag and Last-Modified; conditional and Range requests are honoured."""
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor()
-        cur.execute("SELECT fileurl FROM documents WHERE documentid = %s;", (document_id,))
+        cur.execute("""
+            SELECT fileurl, content_sha256, file_size, file_modified_at, original_filename
+            FROM documents WHERE documentid = %s;
+        """, (document_id,))
         result = cur.fetchone()
-        if result:
-            file_path = result[0]
-            directory = os.path.dirname(file_path)
-            filename = os.path.basename(file_path)
-            return send_from_directory(directory, filename, as_attachment=True)
-        else:
+        if not result or not result[0] or not os.path.isfile(result[0]):
             return jsonify({"error": "File not found."}), 404
+        file_path, etag, size, modified, original_filename = result
+        stat = os.stat(file_path)
+        if etag is None or stat.st_size != size or modified is None or int(stat.st_mtime) != int(modified.timestamp()):
+            # Uploaded before fingerprints were stored, or replaced on disk: hash once and keep it
+            etag, size, modified = file_fingerprint(file_path)
+            cur.execute("""
+                UPDATE documents SET content_sha256 = %s, file_size = %s, file_modified_at = %s WHERE documentid = %s;
+            """, (etag, size, modified, document_id))
+            conn.commit()
     except Exception as e:
         return jsonify({"error": f"Server error: {str(e)}"}), 500
     finally:
         if conn: conn.close()
-    pass
+
+    # Stored files are named by digest; hand the client the name it uploaded
+    filename = original_filename or os.path.basename(file_path)
+    if DOWNLOAD_OFFLOAD in ('x-accel-redirect', 'x-sendfile'):
+        # Answer conditionals here; the proxy serves the bytes (and any Range) itself
+        response = Response(mimetype='application/pdf' if filename.lower().endswith('.pdf') else 'application/octet-stream')
+        response.set_etag(etag)
+        response.last_modified = modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+        if DOWNLOAD_OFFLOAD == 'x-accel-redirect':
+            relative = os.path.relpath(file_path, app.config['UPLOAD_FOLDER'])
+            response.headers['X-Accel-Redirect'] = DOWNLOAD_ACCEL_PREFIX.rstrip('/') + '/' + quote(relative)
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(file_path)
+        return response
+
+    response = send_file(file_path, as_attachment=True, download_name=filename, etag=etag,
+                         last_modified=modified, conditional=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# --- FAQ MATCHING ---
+_FAQ_TOKEN_RE = re.compile(r"\w+")
+
+class FAQIndex:
+    """In-process inverted index (term -> FAQ ids) over FAQ questions, ranked with BM25.
+
+    Built once per worker from the faqs table. The FAQ CRUD routes patch it in
+    place; a change committed by another worker shows up as a newer 'faqs'
+    cache version and triggers a rebuild on the next query.
+    """
+
+    def __init__(self, k1=1.5, b=0.75, min_matched_terms=2):
+        self.k1 = k1
+        self.b = b
+        self.min_matched_terms = min_matched_terms
+        self._lock = threading.RLock()
+        self._faqs = {}      # faq_id -> (answer, question length in terms)
+        self._postings = {}  # term -> {faq_id: term frequency}
+        self._doc_terms = {}  # faq_id -> distinct question terms, so removal only touches their postings
+        self._total_length = 0
+        self._version = None
+
+    @staticmethod
+    def tokenize(text):
+        return _FAQ_TOKEN_RE.findall(text.lower())
+
+    def _add(self, faq_id, question, answer):
+        terms = self.tokenize(question)
+        self._faqs[faq_id] = (answer, len(terms))
+        self._total_length += len(terms)
+        self._doc_terms[faq_id] = frozenset(terms)
+        for term in terms:
+            postings = self._postings.setdefault(term, {})
+            postings[faq_id] = postings.get(faq_id, 0) + 1
+
+    def _remove(self, faq_id):
+        entry = self._faqs.pop(faq_id, None)
+        if entry is None:
+            return
+        self._total_length -= entry[1]
+        for term in self._doc_terms.pop(faq_id):
+            del self._postings[term][faq_id]
+            if not self._postings[term]:
+                del self._postings[term]
+
+    def rebuild(self, version):
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT faqid, question, answer FROM faqs ORDER BY faqid;")
+                rows = cur.fetchall()
+        with self._lock:
+            self._faqs, self._postings, self._doc_terms, self._total_length = {}, {}, {}, 0
+            for faq_id, question, answer in rows:
+                self._add(faq_id, question, answer)
+            self._version = version
+
+    def ensure_current(self):
+        version = cache_versions.get('faqs')
+        if version != self._version:
+            self.rebuild(version)
+
+    def apply_change(self, faq_id, question=None, answer=None):
+        """Patch the index after this worker committed a FAQ insert/update (question given) or delete."""
+        new_version = cache_versions.bump('faqs')
+        with self._lock:
+            if self._version is None:
+                return
+            if new_version is None or new_version != self._version + 1:
+                self._version = None  # another worker changed FAQs as well; rebuild on next query
+                return
+            self._remove(faq_id)
+            if question is not None:
+                self._add(faq_id, question, answer)
+            self._version = new_version
+
+    def best_match(self, query):
+        """(faq_id, answer, score) of the best BM25 match sharing enough terms with the query, else None."""
+        self.ensure_current()
+        query_terms = set(self.tokenize(query))
+        with self._lock:
+            n = len(self._faqs)
+            if not n:
+                return None
+            avg_length = self._total_length / n or 1.0
+            scores, matched = {}, {}
+            for term in query_terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for faq_id, tf in postings.items():
+                    length = self._faqs[faq_id][1]
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / avg_length)
+                    scores[faq_id] = scores.get(faq_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+                    matched[faq_id] = matched.get(faq_id, 0) + 1
+            candidates = [faq_id for faq_id in scores if matched[faq_id] >= self.min_matched_terms]
+            if not candidates:
+                return None
+            best = max(candidates, key=lambda faq_id: (scores[faq_id], -faq_id))
+            return best, self._faqs[best][0], scores[best]
+
+faq_index = FAQIndex(min_matched_terms=FAQ_MIN_MATCHED_TERMS)
 
 @app.route("/api/chatbot", methods=['POST'])
 def chatbot_query():
     data = request.get_json()
     user_query = data.get('query', '').lower()
     if not user_query: return jsonify({"answer": "Please ask a question."})
-    conn = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT question, answer FROM faqs;")
-        all_faqs = cur.fetchall()
-        best_match_answer = "I'm sorry, I don't have an answer for that."
-        highest_score = 0
-        query_words = set(user_query.split())
-        for question, answer in all_faqs:
-            question_words = set(question.lower().split())
-            score = len(query_words.intersection(question_words))
-            if score > highest_score:
-                highest_score = score
-                best_match_answer = answer
-        if highest_score < 2:
-            best_match_answer = "I'm sorry, I don't have a specific answer for that. Please try rephrasing."
-        return jsonify({"answer": best_match_answer})
+        match = faq_index.best_match(user_query)
+        if match is None:
+            return jsonify({"answer": "I'm sorry, I don't have a specific answer for that. Please try rephrasing."})
+        return jsonify({"answer": match[1]})
     except Exception as e:
         return jsonify({"answer": f"An error occurred: {str(e)}"}), 500
-    finally:
-        if conn: conn.close()
-    pass
 
 # === USER AUTHENTICATION & REGISTRATION ===
 
@@ -659,16 +3221,7 @@ def debug_session():
 @app.route("/api/roles", methods=['GET'])
 def get_roles():
     """Endpoint to fetch all available user roles."""
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT roleid, rolename FROM roles ORDER BY rolename;")
-        roles = [{"roleID": row[0], "roleName": row[1]} for row in cur.fetchall()]
-        return jsonify(roles)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        if conn: conn.close()
+    return reference_data_response("roles")
 
 @app.route("/api/admin/users", methods=['GET'])
 def admin_get_users():
@@ -695,17 +3248,6 @@ def admin_get_users():
     finally:
         if conn: conn.close()
 
-def require_role(role_name):
-    """Decorator to protect routes based on user role."""
-    def decorator(f):
-        @wraps(f)
-        def wrapped(*args, **kwargs):
-            if 'user_role' not in session or session['user_role'] != role_name:
-                return jsonify({"error": "Unauthorized"}), 403
-            return f(*args, **kwargs)
-        return wrapped
-    return decorator
-
 @app.route("/api/regulator/documents", methods=['GET'])
 @require_role('Regulator Editor')
 def get_regulator_documents():
@@ -820,19 +3362,7 @@ def admin_delete_user(user_id):
 # --- Regulators ---
 @app.route("/api/regulators", methods=['GET'])
 def get_regulators():
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT regulatorid AS id, name, abbreviation FROM regulators ORDER BY name;")
-        data = cur.fetchall()
-        data_list = [{"id": row[0], "name": row[1], "abbreviation": row[2]} for row in data]
-        return jsonify(data_list)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        if conn: conn.close()
-    pass
+    return reference_data_response("regulators")
 
 @app.route("/api/regulators", methods=['POST'])
 def create_regulator():
@@ -850,6 +3380,7 @@ def create_regulator():
         cur.execute("INSERT INTO regulators (name, abbreviation) VALUES (%s, %s) RETURNING regulatorid;", (name, abbreviation))
         new_id = cur.fetchone()[0]
         conn.commit()
+        reference_cache.invalidate("regulators")
         cur.close()
         return jsonify({"success": True, "message": "Regulator created.", "new_regulator": {"regulatorID": new_id, "name": name, "abbreviation": abbreviation}}), 201
     except (Exception, psycopg2.DatabaseError) as error:
@@ -875,6 +3406,7 @@ def update_regulator(regulator_id):
         cur = conn.cursor()
         cur.execute("UPDATE regulators SET name = %s, abbreviation = %s WHERE regulatorid = %s;", (name, abbreviation, regulator_id))
         conn.commit()
+        reference_cache.invalidate("regulators")
         cur.close()
         return jsonify({"success": True, "message": "Regulator updated."})
     except Exception as e:
@@ -892,6 +3424,7 @@ def delete_regulator(regulator_id):
         cur = conn.cursor()
         cur.execute("DELETE FROM regulators WHERE regulatorid = %s;", (regulator_id,))
         conn.commit()
+        reference_cache.invalidate("regulators")
         return jsonify({"success": True})
     except psycopg2.IntegrityError:
         conn.rollback()
@@ -906,20 +3439,8 @@ def delete_regulator(regulator_id):
 # --- Document Types ---
 @app.route("/api/document-types", methods=['GET'])
 def get_document_types():
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT typeid AS id, typename AS name FROM document_types ORDER BY typename;")
-        data = cur.fetchall()
-        data_list = [{"id": row[0], "name": row[1]} for row in data]
-        return jsonify(data_list)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        if conn: conn.close()
-    pass
-        
+    return reference_data_response("document_types")
+
 @app.route("/api/document-types", methods=['POST'])
 def create_document_type():
     data = request.get_json()
@@ -932,6 +3453,7 @@ def create_document_type():
         cur.execute("INSERT INTO document_types (typename) VALUES (%s) RETURNING typeid;", (typeName,))
         new_id = cur.fetchone()[0]
         conn.commit()
+        reference_cache.invalidate("document_types")
         return jsonify({"success": True, "new_document_type": {"typeID": new_id, "typeName": typeName}}), 201
     except Exception as e:
         if conn: conn.rollback()
@@ -952,6 +3474,7 @@ def update_document_type(type_id):
         cur = conn.cursor()
         cur.execute("UPDATE document_types SET typename = %s WHERE typeid = %s;", (typeName, type_id))
         conn.commit()
+        reference_cache.invalidate("document_types")
         cur.close()
         return jsonify({"success": True, "message": "Document type updated."})
     except Exception as e:
@@ -970,6 +3493,7 @@ def delete_document_type(type_id):
         cur = conn.cursor()
         cur.execute("DELETE FROM document_types WHERE typeid = %s;", (type_id,))
         conn.commit()
+        reference_cache.invalidate("document_types")
         cur.close()
         return jsonify({"success": True, "message": "Document archived successfully."})
     except psycopg2.IntegrityError:
@@ -985,19 +3509,7 @@ def delete_document_type(type_id):
 # --- User Types ---
 @app.route("/api/user-types", methods=['GET'])
 def get_user_types():
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT usertypeid AS id, typename AS name FROM user_types ORDER BY typename;")
-        data = cur.fetchall()
-        data_list = [{"id": row[0], "name": row[1]} for row in data]
-        return jsonify(data_list)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        if conn: conn.close()
-    pass
+    return reference_data_response("user_types")
 
 @app.route("/api/user-types", methods=['POST'])
 def create_user_type():
@@ -1018,6 +3530,7 @@ def create_user_type():
         new_id = cur.fetchone()[0]
         
         conn.commit()
+        reference_cache.invalidate("user_types")
         cur.close()
         
         return jsonify({"success": True, "new_user_type": {"userTypeID": new_id, "typeName": typeName}}), 201
@@ -1047,6 +3560,7 @@ def update_user_type(user_type_id):
         cur = conn.cursor()
         cur.execute("UPDATE user_types SET typename = %s WHERE usertypeid = %s;", (typeName, user_type_id))
         conn.commit()
+        reference_cache.invalidate("user_types")
         cur.close()
         return jsonify({"success": True, "message": "User type updated."})
     except Exception as e:
@@ -1064,6 +3578,7 @@ def delete_user_type(user_type_id):
         cur = conn.cursor()
         cur.execute("DELETE FROM user_types WHERE usertypeid = %s;", (user_type_id,))
         conn.commit()
+        reference_cache.invalidate("user_types")
         cur.close()
         return jsonify({"success": True})
     except psycopg2.IntegrityError:
@@ -1083,9 +3598,14 @@ def get_all_documents():
     try:
         conn = get_db_connection()
         cur = conn.cursor()
-        cur.execute("SELECT documentid, title FROM documents ORDER BY title;")
+        cur.execute("""
+            SELECT d.documentid, d.title, d.status, j.job_id
+            FROM documents d
+            LEFT JOIN LATERAL (%s) j ON TRUE
+            ORDER BY d.title;
+        """ % LATEST_INGESTION_JOB_SQL)
         data = cur.fetchall()
-        data_list = [{"documentID": row[0], "title": row[1]} for row in data]
+        data_list = [{"documentID": row[0], "title": row[1], **document_status_fields(row[2], row[3])} for row in data]
         return jsonify(data_list)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1114,23 +3634,16 @@ def create_document():
     if not all([title, type_id, service_ids]):
         return jsonify({"error": "Title, type, and at least one service are required."}), 400
 
-    # --- 3. Process the file and generate AI summary ---
-    file.seek(0) # Rewind file before reading
-    text_content = extract_text_from_pdf(file) if file.filename.lower().endswith('.pdf') else ""
-    cleaned_text = clean_text(text_content) # Apply the cleaning function
-    ai_summary = generate_ai_summary(cleaned_text) # Re-using your function name
-    file.seek(0)  # Rewind file after reading for AI
-
-    # --- 4. Save the file to disk ---
-    filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_path)
+    # --- 3. Save the file to disk, content-addressed ---
+    original_filename = secure_filename(file.filename)
+    file_path, content_sha256, file_size, file_modified_at = store_upload(file)
 
-    # --- 5. Save metadata to the database ---
+    # --- 4. Save a pending document and queue its ingestion job ---
+    # Extraction, chunking, embeddings and the AI summary run in the background
+    # (see run_ingestion_job); poll the returned statusURL for progress.
     conn = None
     try:
         conn = get_db_connection()
-        pgvector.psycopg2.register_vector(conn) # CRITICAL: Register vector type with the connection
         cur = conn.cursor()
 
         # Get the admin's associated regulator ID
@@ -1142,10 +3655,12 @@ def create_document():
 
         # Insert the document and get its new ID
         sql_doc = """
-            INSERT INTO documents (title, regulatorid, typeid, fileurl, uploadedby, summary_ai) 
-            VALUES (%s, %s, %s, %s, %s, %s) RETURNING documentid;
+            INSERT INTO documents (title, regulatorid, typeid, fileurl, uploadedby, summary_ai, status,
+                                   content_sha256, file_size, file_modified_at, original_filename)
+            VALUES (%s, %s, %s, %s, %s, NULL, 'pending', %s, %s, %s, %s) RETURNING documentid;
         """
-        cur.execute(sql_doc, (title, admin_regulator_id, int(type_id), file_path, uploader_id, ai_summary))
+        cur.execute(sql_doc, (title, admin_regulator_id, int(type_id), file_path, uploader_id,
+                              content_sha256, file_size, file_modified_at, original_filename))
         
         # --- ROBUSTNESS CHECK ---
         new_doc_id_row = cur.fetchone()
@@ -1154,22 +3669,22 @@ def create_document():
         new_doc_id = new_doc_id_row[0]
         # --- END OF CHECK ---
 
-        # --- NEW: Process and store embeddings ---
-        text_content = extract_text_from_pdf(file)
-        if cleaned_text:
-            chunks = chunk_text(cleaned_text) # Use a helper to split text into chunks
-            for chunk in chunks:
-                embedding = get_embedding(chunk)
-                cur.execute(
-                    "INSERT INTO document_chunks (document_id, chunk_text, embedding) VALUES (%s, %s, %s);",
-                    (new_doc_id, chunk, embedding)
-                )
         # Link the new document to the selected financial services
         for service_id in service_ids:
             cur.execute("INSERT INTO document_services (documentid, serviceid) VALUES (%s, %s);", (new_doc_id, int(service_id)))
+
+        cur.execute("INSERT INTO ingestion_jobs (document_id) VALUES (%s) RETURNING job_id;", (new_doc_id,))
+        job_id = cur.fetchone()[0]
         
         conn.commit()
-        return jsonify({"success": True, "message": "File uploaded successfully."}), 201
+        ingestion_workers.wake()
+        return jsonify({
+            "success": True,
+            "message": "File uploaded successfully. Processing has started.",
+            "documentID": new_doc_id,
+            "jobID": job_id,
+            "statusURL": f"/api/ingestion-jobs/{job_id}"
+        }), 202
 
     except Exception as e:
         if conn:
@@ -1182,6 +3697,419 @@ def create_document():
             conn.close()
     pass
 
+@app.route("/api/ingestion-jobs/<int:job_id>", methods=['GET'])
+def get_ingestion_job(job_id):
+    """Reports the status of a document ingestion job, stage by stage."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT job_id, document_id, status, stage, progress, attempts, error, created_at, updated_at, finished_at
+            FROM ingestion_jobs WHERE job_id = %s;
+        """, (job_id,))
+        row = cur.fetchone()
+        if not row:
+            return jsonify({"error": "Job not found"}), 404
+        progress = row[4] or {}
+        return jsonify({
+            "jobID": row[0],
+            "documentID": row[1],
+            "status": row[2],
+            "currentStage": row[3],
+            "stages": [{"stage": stage, **progress.get(stage, {"state": "pending"})} for stage in INGEST_STAGES],
+            "attempts": row[5],
+            "error": row[6],
+            "created_at": row[7],
+            "updated_at": row[8],
+            "finished_at": row[9]
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if conn: conn.close()
+
+# --- VECTOR INDEX MANAGEMENT ---
+# The ANN indexes only cover live chunks: every search filters on NOT is_archived,
+# so archived documents neither bloat the index nor eat into the candidate list.
+VECTOR_INDEX_NAMES = {
+    "hnsw": "document_chunks_embedding_live_hnsw_idx",
+    "ivfflat": "document_chunks_embedding_live_ivfflat_idx",
+}
+
+# Storage mode -> (operator class, distance operator, default re-rank factor). 'halfvec'
+# halves the index and loses almost no recall; 'binary' is 32x smaller and needs a
+# wider shortlist. The table keeps float32 vectors either way, for the re-ranking pass.
+VECTOR_STORAGE_MODES = {
+    "vector": ("vector_cosine_ops", "<=>", 1),
+    "halfvec": ("halfvec_cosine_ops", "<=>", 2),
+    "binary": ("bit_hamming_ops", "<~>", 8),
+}
+if VECTOR_STORAGE not in VECTOR_STORAGE_MODES:
+    raise ValueError(f"Unknown ATAS_VECTOR_STORAGE '{VECTOR_STORAGE}' (expected one of {', '.join(VECTOR_STORAGE_MODES)}).")
+
+def vector_storage_expression(storage, column, dim):
+    """What a storage mode indexes for `column`; searches must order by the identical expression."""
+    if storage == "vector":
+        return column
+    if storage == "halfvec":
+        return f"({column}::halfvec({int(dim)}))"
+    if storage == "binary":
+        return f"(binary_quantize({column})::bit({int(dim)}))"
+    raise ValueError(f"Unknown vector storage mode: {storage}")
+
+def vector_index_name(method, storage="vector"):
+    if storage == "vector":
+        return VECTOR_INDEX_NAMES[method]
+    return f"document_chunks_embedding_live_{method}_{storage}_idx"
+
+def rerank_shortlist(storage, limit):
+    """Rows to pull from a compact index so that `limit` survive re-ranking on full vectors."""
+    return limit * (VECTOR_RERANK_FACTOR or VECTOR_STORAGE_MODES[storage][2])
+
+def vector_index_ddl(method="hnsw", m=16, ef_construction=64, lists=100, storage="vector", dim=None):
+    """CREATE INDEX CONCURRENTLY statement for a partial cosine-distance ANN index on live document_chunks."""
+    if method == "hnsw":
+        options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+    elif method == "ivfflat":
+        options = f"lists = {int(lists)}"
+    else:
+        raise ValueError(f"Unknown vector index method: {method}")
+    opclass = VECTOR_STORAGE_MODES[storage][0]
+    return (f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {vector_index_name(method, storage)} "
+            f"ON document_chunks USING {method} ({vector_storage_expression(storage, 'embedding', dim)} {opclass}) "
+            f"WITH ({options}) WHERE NOT is_archived;")
+
+def vector_indexes_on(cur, column="embedding"):
+    """[(name, definition)] of the HNSW/IVFFlat indexes over a document_chunks column, expression indexes included."""
+    cur.execute("""
+        SELECT DISTINCT i.relname, pg_get_indexdef(i.oid)
+        FROM pg_depend dep
+        JOIN pg_class i ON i.oid = dep.objid AND i.relkind = 'i'
+        JOIN pg_am am ON am.oid = i.relam
+        JOIN pg_attribute a ON a.attrelid = dep.refobjid AND a.attnum = dep.refobjsubid
+        WHERE dep.classid = 'pg_class'::regclass AND dep.refobjid = 'document_chunks'::regclass
+          AND a.attname = %s AND am.amname IN ('hnsw', 'ivfflat')
+        ORDER BY 1;
+    """, (column,))
+    return cur.fetchall()
+
+def apply_vector_search_tuning(cur, ef_search=None, probes=None, iterative_scan=None):
+    """SET LOCAL the ANN recall/speed knobs; they reset when the transaction ends."""
+    if ef_search:
+        cur.execute("SET LOCAL hnsw.ef_search = %s;", (int(ef_search),))
+    if probes:
+        cur.execute("SET LOCAL ivfflat.probes = %s;", (int(probes),))
+    if iterative_scan:
+        # pgvector >= 0.8: keep scanning the graph until enough rows pass the filters
+        cur.execute("SET LOCAL hnsw.iterative_scan = %s;", (iterative_scan,))
+        cur.execute("SET LOCAL ivfflat.iterative_scan = %s;", (iterative_scan,))
+
+def _int_list_param(name, data):
+    """Integers from repeated query-string values or a JSON scalar/list; None when the filter is absent."""
+    values = request.args.getlist(name)
+    if not values:
+        raw = (data or {}).get(name)
+        if raw is None or raw == '':
+            return None
+        values = raw if isinstance(raw, list) else [raw]
+    try:
+        return sorted({int(value) for value in values})
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer or a list of integers.")
+
+def _bool_param(name, data):
+    value = request.args.get(name, (data or {}).get(name))
+    return value is True or str(value).lower() in ('1', 'true', 'yes')
+
+def chunk_filter_sql(filters, alias):
+    """WHERE fragment over the denormalized document_chunks filter columns, using named params from filters."""
+    filters = filters or {}
+    clauses = [] if filters.get("include_archived") else [f"NOT {alias}.is_archived"]
+    if filters.get("service_ids") is not None:
+        clauses.append(f"{alias}.service_ids && %(service_ids)s::integer[]")
+    if filters.get("regulator_ids"):
+        clauses.append(f"{alias}.regulator_id = ANY(%(regulator_ids)s)")
+    if filters.get("type_ids"):
+        clauses.append(f"{alias}.type_id = ANY(%(type_ids)s)")
+    return " AND ".join(clauses) or "TRUE"
+
+def _bounded_int_param(name, data, low, high, default=None):
+    """Read an integer knob from the query string (falling back to the JSON body) and range-check it."""
+    value = request.args.get(name, (data or {}).get(name))
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer.")
+    if not low <= value <= high:
+        raise ValueError(f"{name} must be between {low} and {high}.")
+    return value
+
+def parse_search_filters(data):
+    """Document filters for search requests.
+
+    service_id / regulator_id / type_id take one id or a list, subscribed=true
+    limits results to the caller's subscribed services, and include_archived is
+    honoured for administrators only. Raises ValueError or PermissionError.
+    """
+    service_ids = _int_list_param('service_id', data)
+    regulator_ids = _int_list_param('regulator_id', data)
+    type_ids = _int_list_param('type_id', data)
+    if _bool_param('subscribed', data):
+        user_id = session.get('user_id')
+        if not user_id:
+            raise PermissionError("Log in to search within your subscriptions.")
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT serviceid FROM subscriptions WHERE userid = %s;", (user_id,))
+                subscribed = {row[0] for row in cur.fetchall()}
+        service_ids = sorted(subscribed if service_ids is None else subscribed & set(service_ids))
+
+    filters = {}
+    if service_ids is not None:
+        filters["service_ids"] = service_ids
+    if regulator_ids:
+        filters["regulator_ids"] = regulator_ids
+    if type_ids:
+        filters["type_ids"] = type_ids
+    if _bool_param('include_archived', data) and session.get('user_role') in ARCHIVE_VIEWER_ROLES:
+        filters["include_archived"] = True
+    return filters
+
+# --- FULL-TEXT SEARCH ---
+# ts_headline marks matches with control characters; the snippet is HTML-escaped
+# afterwards and only then are the markers turned into <mark> tags.
+_HEADLINE_OPTIONS = "StartSel=\x01, StopSel=\x02, MaxWords=35, MinWords=15, MaxFragments=2, FragmentDelimiter=\" … \""
+
+def _highlight(snippet):
+    return html.escape(snippet or "").replace("\x01", "<mark>").replace("\x02", "</mark>")
+
+def keyword_search_faqs(cur, query, limit):
+    """Top FAQs for a web-style query (quotes, OR, -term) ranked with ts_rank_cd over the GIN-indexed tsvector."""
+    cur.execute("""
+        WITH q AS (SELECT websearch_to_tsquery('english', %(query)s) AS query)
+        SELECT f.faqid, f.question, f.answer, f.rank,
+               ts_headline('english', f.answer, q.query, %(options)s)
+        FROM (
+            SELECT faqid, question, answer, ts_rank_cd(search_tsv, q.query) AS rank
+            FROM faqs, q
+            WHERE search_tsv @@ q.query
+            ORDER BY rank DESC
+            LIMIT %(limit)s
+        ) f, q
+        ORDER BY f.rank DESC;
+    """, {"query": query, "limit": limit, "options": _HEADLINE_OPTIONS})
+    return [{"faqID": row[0], "question": row[1], "answer": row[2], "rank": row[3], "snippet": _highlight(row[4])}
+            for row in cur.fetchall()]
+
+def keyword_search_documents(cur, query, limit, candidates=200, filters=None):
+    """Best-matching chunk per live document, boosted when the title matches too; snippets only for the final rows."""
+    cur.execute(f"""
+        WITH q AS (SELECT websearch_to_tsquery('english', %(query)s) AS query),
+        hits AS (
+            SELECT dc.document_id, dc.chunk_text, ts_rank_cd(dc.chunk_tsv, q.query) AS rank
+            FROM document_chunks dc, q
+            WHERE dc.chunk_tsv @@ q.query AND {chunk_filter_sql(filters, "dc")}
+            ORDER BY rank DESC
+            LIMIT %(candidates)s
+        ),
+        best AS (
+            SELECT DISTINCT ON (document_id) document_id, chunk_text, rank
+            FROM hits
+            ORDER BY document_id, rank DESC
+        ),
+        ranked AS (
+            SELECT d.documentid, d.title, b.chunk_text, b.rank + ts_rank_cd(d.title_tsv, q.query) AS rank
+            FROM best b
+            JOIN documents d ON d.documentid = b.document_id, q
+            ORDER BY rank DESC
+            LIMIT %(limit)s
+        )
+        SELECT r.documentid, r.title, r.rank, ts_headline('english', r.chunk_text, q.query, %(options)s)
+        FROM ranked r, q
+        ORDER BY r.rank DESC;
+    """, {"query": query, "limit": limit, "candidates": candidates, "options": _HEADLINE_OPTIONS, **(filters or {})})
+    return [{"documentID": row[0], "source_document": row[1], "rank": row[2], "snippet": _highlight(row[3])}
+            for row in cur.fetchall()]
+
+@app.route("/api/keyword-search", methods=['GET'])
+def keyword_search():
+    """Full-text search over FAQs and document text, with highlighted snippets."""
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"error": "A search query is required."}), 400
+    scope = request.args.get('type', 'all')
+    if scope not in ('all', 'faq', 'document'):
+        return jsonify({"error": "type must be one of all, faq, document."}), 400
+    try:
+        limit = _bounded_int_param('limit', None, 1, 50, default=10)
+        filters = parse_search_filters(None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except PermissionError as e:
+        return jsonify({"error": str(e)}), 401
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        return jsonify({
+            "faqs": keyword_search_faqs(cur, query, limit) if scope in ('all', 'faq') else [],
+            "documents": keyword_search_documents(cur, query, limit, filters=filters) if scope in ('all', 'document') else []
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if conn: conn.close()
+
+# --- HYBRID RETRIEVAL ---
+SEARCH_MODES = ("hybrid", "vector")
+
+def nearest_chunks_sql(filters, limit_param, storage="vector", dim=None):
+    """SELECT of (id, document_id, chunk_text, page_start, page_end, distance) for the nearest chunks.
+
+    The inner ORDER BY/LIMIT on document_chunks alone is what lets the planner
+    walk the HNSW/IVFFlat index; the filters are evaluated inside that scan
+    rather than after it. Compact storage modes order by the indexed expression
+    into a %(shortlist)s-row shortlist, then re-rank it by exact cosine distance.
+    """
+    where = chunk_filter_sql(filters, "dc")
+    if storage == "vector":
+        return f"""
+            SELECT dc.id, dc.document_id, dc.chunk_text, dc.page_start, dc.page_end, dc.embedding <=> %(embedding)s AS distance
+            FROM document_chunks dc
+            WHERE {where}
+            ORDER BY dc.embedding <=> %(embedding)s
+            LIMIT %({limit_param})s"""
+    operator = VECTOR_STORAGE_MODES[storage][1]
+    approximate = (f"{vector_storage_expression(storage, 'dc.embedding', dim)} {operator} "
+                   f"{vector_storage_expression(storage, '%(embedding)s::vector', dim)}")
+    return f"""
+            SELECT id, document_id, chunk_text, page_start, page_end, embedding <=> %(embedding)s AS distance
+            FROM (
+                SELECT dc.id, dc.document_id, dc.chunk_text, dc.page_start, dc.page_end, dc.embedding
+                FROM document_chunks dc
+                WHERE {where}
+                ORDER BY {approximate}
+                LIMIT %(shortlist)s
+            ) shortlist
+            ORDER BY distance
+            LIMIT %({limit_param})s"""
+
+def vector_search(cur, query_embedding, k, filters=None, storage=VECTOR_STORAGE):
+    """Nearest chunks by cosine distance."""
+    cur.execute(f"""
+        SELECT nearest.chunk_text, d.title, d.documentid, nearest.distance, nearest.page_start, nearest.page_end
+        FROM ({nearest_chunks_sql(filters, "k", storage, len(query_embedding))}
+        ) nearest
+        JOIN documents d ON nearest.document_id = d.documentid
+        ORDER BY nearest.distance;
+    """, {"embedding": query_embedding, "k": k, "shortlist": rerank_shortlist(storage, k), **(filters or {})})
+    return cur.fetchall()
+
+def hybrid_search(cur, query, query_embedding, k, filters=None, faq_limit=2, storage=VECTOR_STORAGE):
+    """Reciprocal-rank fusion of the vector and full-text candidate lists, plus FAQ matches, in one round trip.
+
+    Each chunk scores sum(weight / (RRF_K + rank)) over the lists it appears in;
+    at most HYBRID_MAX_CHUNKS_PER_DOCUMENT chunks per document are kept.
+    Returns (document rows, faq rows).
+    """
+    cur.execute(f"""
+        WITH q AS (SELECT websearch_to_tsquery('english', %(query)s) AS query),
+        vector_hits AS (
+            SELECT id, document_id, chunk_text, page_start, page_end, ROW_NUMBER() OVER (ORDER BY distance) AS rank
+            FROM ({nearest_chunks_sql(filters, "candidates", storage, len(query_embedding))}
+            ) nearest
+        ),
+        keyword_hits AS (
+            SELECT id, document_id, chunk_text, page_start, page_end, ROW_NUMBER() OVER (ORDER BY score DESC) AS rank
+            FROM (
+                SELECT dc.id, dc.document_id, dc.chunk_text, dc.page_start, dc.page_end, ts_rank_cd(dc.chunk_tsv, q.query) AS score
+                FROM document_chunks dc, q
+                WHERE dc.chunk_tsv @@ q.query AND {chunk_filter_sql(filters, "dc")}
+                ORDER BY score DESC
+                LIMIT %(candidates)s
+            ) matched
+        ),
+        fused AS (
+            SELECT COALESCE(v.id, kw.id) AS id,
+                   COALESCE(v.document_id, kw.document_id) AS document_id,
+                   COALESCE(v.chunk_text, kw.chunk_text) AS chunk_text,
+                   COALESCE(v.page_start, kw.page_start) AS page_start,
+                   COALESCE(v.page_end, kw.page_end) AS page_end,
+                   COALESCE(%(vector_weight)s / (%(rrf_k)s + v.rank), 0)
+                     + COALESCE(%(keyword_weight)s / (%(rrf_k)s + kw.rank), 0) AS score
+            FROM vector_hits v
+            FULL OUTER JOIN keyword_hits kw ON kw.id = v.id
+        ),
+        per_document AS (
+            SELECT fused.*, ROW_NUMBER() OVER (PARTITION BY document_id ORDER BY score DESC) AS doc_rank
+            FROM fused
+        ),
+        faq_hits AS (
+            SELECT faqid, question, answer, ts_rank_cd(search_tsv, q.query) AS score
+            FROM faqs, q
+            WHERE search_tsv @@ q.query
+            ORDER BY score DESC
+            LIMIT %(faq_limit)s
+        )
+        (SELECT 'document' AS kind, d.title, p.chunk_text, d.documentid, p.score, p.page_start, p.page_end
+         FROM per_document p
+         JOIN documents d ON d.documentid = p.document_id
+         WHERE p.doc_rank <= %(per_document)s
+         ORDER BY p.score DESC
+         LIMIT %(k)s)
+        UNION ALL
+        (SELECT 'faq', question, answer, faqid, score, NULL, NULL FROM faq_hits ORDER BY score DESC);
+    """, {
+        "query": query,
+        "embedding": query_embedding,
+        "k": k,
+        "candidates": max(k, HYBRID_CANDIDATES),
+        "shortlist": rerank_shortlist(storage, max(k, HYBRID_CANDIDATES)),
+        "rrf_k": HYBRID_RRF_K,
+        "vector_weight": HYBRID_VECTOR_WEIGHT,
+        "keyword_weight": HYBRID_KEYWORD_WEIGHT,
+        "per_document": HYBRID_MAX_CHUNKS_PER_DOCUMENT,
+        "faq_limit": faq_limit,
+        **(filters or {}),
+    })
+    rows = cur.fetchall()
+    documents = [(row[2], row[1], row[3], row[4], row[5], row[6]) for row in rows if row[0] == 'document']
+    faqs = [(row[1], row[2], row[3]) for row in rows if row[0] == 'faq']
+    return documents, faqs
+
+def run_smart_search(cur, query, query_embedding, mode="hybrid", k=3, filters=None):
+    """Result list for /api/smart-search: FAQ matches first, then document chunks."""
+    if mode == "hybrid":
+        doc_results, faq_results = hybrid_search(cur, query, query_embedding, k, filters=filters)
+    else:
+        doc_results = vector_search(cur, query_embedding, k, filters=filters)
+        faq_results = [(faq["question"], faq["answer"], faq["faqID"]) for faq in keyword_search_faqs(cur, query, 2)]
+
+    final_results = []
+    
+    # Add FAQ results, marked with a type
+    for row in faq_results:
+        final_results.append({
+            "type": "faq",
+            "question": row[0],
+            "answer": row[1]
+        })
+    
+    # Add Document chunk results, marked with a type
+    for row in doc_results:
+        final_results.append({
+            "type": "document",
+            "text": row[0],
+            "source_document": row[1],
+            "documentID": row[2],
+            "pages": [row[4], row[5]] if row[4] is not None else None
+        })
+    return final_results
+
 # --- NEW SMART SEARCH ENDPOINT ---
 @app.route("/api/smart-search", methods=['POST'])
 def smart_search():
@@ -1189,57 +4117,68 @@ def smart_search():
     query = data.get('query')
     if not query:
         return jsonify({"error": "A search query is required."}), 400
+    # Optional ANN tuning: higher ef_search (HNSW) / probes (IVFFlat) trade latency for recall
+    try:
+        ef_search = _bounded_int_param('ef_search', data, 1, 1000, default=HNSW_EF_SEARCH)
+        probes = _bounded_int_param('probes', data, 1, 1000, default=IVFFLAT_PROBES)
+        k = _bounded_int_param('k', data, 1, 50, default=SEARCH_RESULTS_K)
+        # Filters by service/regulator/type/subscriptions are pushed into the vector scan;
+        # archived documents are excluded unless an administrator asks for them
+        filters = parse_search_filters(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except PermissionError as e:
+        return jsonify({"error": str(e)}), 401
+    narrowed = any(key in filters for key in ("service_ids", "regulator_ids", "type_ids"))
+    if narrowed and ef_search is None:
+        ef_search = FILTERED_HNSW_EF_SEARCH  # widen the HNSW candidate list so filtered searches still fill k
+    mode = request.args.get('mode', data.get('mode', SEARCH_MODE))
+    if mode not in SEARCH_MODES:
+        return jsonify({"error": f"mode must be one of {', '.join(SEARCH_MODES)}."}), 400
+    if VECTOR_STORAGE != "vector":
+        # An HNSW scan returns at most ef_search rows, and the re-ranking pass needs the whole shortlist
+        shortlist = rerank_shortlist(VECTOR_STORAGE, max(k, HYBRID_CANDIDATES) if mode == "hybrid" else k)
+        ef_search = min(1000, max(ef_search or 40, shortlist))
 
     conn = None
     try:
+        # 0. Serve repeat searches from the result cache. Entries are keyed by the
+        #    corpus version, which every write to documents/chunks/FAQs bumps.
+        #    Searches are POSTs, so there is no ETag/304 revalidation (RFC 7232 answers a
+        #    failed conditional POST with 412); repeats are absorbed by this cache instead.
+        cache_key = search_cache_key(query, {"ef_search": ef_search, "probes": probes, "k": k, "mode": mode, **filters})
+        corpus_version = cache_versions.get('corpus')
+        cached = search_result_cache.get((corpus_version, cache_key))
+        if cached is not None:
+            return json_bytes_response(cached)
+
         # 1. Convert the user's query into a numpy array embedding
-        cleaned_query = clean_text(query)
-        query_embedding = get_embedding(cleaned_query)
+        cleaned_query = clean_query(query)
+        provider = active_embedding_provider()
+        query_embedding = get_query_embedding(cleaned_query, provider)
         
-        # 2. Connect and register the vector type with the connection
+        # 2. Check out a pooled connection (the vector type is already registered on it)
         conn = get_db_connection()
-        pgvector.psycopg2.register_vector(conn)
         cur = conn.cursor()
-
-        # 3. Perform the similarity search
-        sql = """
-            SELECT dc.chunk_text, d.title, d.documentid, (dc.embedding <=> %s) AS distance
-            FROM document_chunks dc
-            JOIN documents d ON dc.document_id = d.documentid
-            ORDER BY distance LIMIT 3;
-        """
-        # 4. Pass the numpy array directly to the execute function
-        cur.execute(sql, (query_embedding,))
-        doc_results = cur.fetchall()
-
-        # --- 2. Search FAQs (Keyword Search) ---
-        # A simple search using ILIKE for case-insensitive matching
-        sql_faqs = "SELECT question, answer, faqid FROM faqs WHERE question ILIKE %s OR answer ILIKE %s LIMIT 2;"
-        search_term = f"%{query}%"
-        cur.execute(sql_faqs, (search_term, search_term))
-        faq_results = cur.fetchall()
-
-        # --- 3. Combine and Format Results ---
-        final_results = []
-        
-        # Add FAQ results, marked with a type
-        for row in faq_results:
-            final_results.append({
-                "type": "faq",
-                "question": row[0],
-                "answer": row[1]
-            })
-        
-        # Add Document chunk results, marked with a type
-        for row in doc_results:
-            final_results.append({
-                "type": "document",
-                "text": row[0],
-                "source_document": row[1],
-                "documentID": row[2]
-            })
+        # A re-embedding cutover may have landed since the query was embedded; re-embed with the new model if so
+        current = locked_embedding_provider(cur)
+        try:
+            check_embedding_dimension(cur, current)
+        except ValueError as e:
+            app.logger.error(f"Smart search unavailable: {str(e)}")
+            return jsonify({"error": "Search is temporarily unavailable: the embedding model does not match "
+                                     "the stored document vectors."}), 503
+        if current is not provider:
+            query_embedding = get_query_embedding(cleaned_query, current)
+        apply_vector_search_tuning(cur, ef_search=ef_search, probes=probes,
+                                   iterative_scan=HNSW_ITERATIVE_SCAN if narrowed else None)
+
+        # 3. Vector + full-text retrieval fused in one query (or the vector-only path)
+        final_results = run_smart_search(cur, query, query_embedding, mode=mode, k=k, filters=filters)
         
-        return jsonify(final_results)
+        body = json.dumps(final_results, default=str).encode('utf-8')
+        search_result_cache.put((corpus_version, cache_key), body)
+        return json_bytes_response(body)
     except Exception as e:
         print(f"SMART SEARCH ERROR: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -1258,6 +4197,7 @@ def update_document(document_id):
         cur = conn.cursor()
         cur.execute("UPDATE documents SET title = %s WHERE documentid = %s;", (title, document_id))
         conn.commit()
+        cache_versions.bump('corpus')
         cur.close()
         return jsonify({"success": True, "message": "Document updated."})
     except Exception as e:
@@ -1275,7 +4215,9 @@ def delete_document(document_id):
         conn = get_db_connection()
         cur = conn.cursor()        
         cur.execute("UPDATE documents SET is_archived = TRUE WHERE documentid = %s;", (document_id,))
+        sync_chunk_filters(cur, document_id)
         conn.commit()
+        cache_versions.bump('corpus')
         return jsonify({"success": True, "message": f"Document {document_id} deleted."})
     except Exception as e:
         if conn: conn.rollback()
@@ -1314,6 +4256,8 @@ def create_faq():
         cur.execute("INSERT INTO faqs (question, answer) VALUES (%s, %s) RETURNING faqid;", (question, answer))
         new_id = cur.fetchone()[0]
         conn.commit()
+        cache_versions.bump('corpus')
+        faq_index.apply_change(new_id, question, answer)
         return jsonify({"success": True, "new_faq": {"faqID": new_id, "question": question}}), 201
     except Exception as e:
         if conn: conn.rollback()
@@ -1335,6 +4279,8 @@ def update_faq(faq_id):
         cur = conn.cursor()
         cur.execute("UPDATE faqs SET question = %s, answer = %s WHERE faqid = %s;", (question, answer, faq_id))
         conn.commit()
+        cache_versions.bump('corpus')
+        faq_index.apply_change(faq_id, question, answer)
         cur.close()
         return jsonify({"success": True, "message": "FAQ updated."})
     except Exception as e:
@@ -1352,6 +4298,8 @@ def delete_faq(faq_id):
         cur = conn.cursor()
         cur.execute("DELETE FROM faqs WHERE faqid = %s;", (faq_id,))
         conn.commit()
+        cache_versions.bump('corpus')
+        faq_index.apply_change(faq_id)
         return jsonify({"success": True})
     except Exception as e:
         if conn: conn.rollback()
@@ -1474,7 +4422,9 @@ def restore_document(document_id):
     try:
         cur = conn.cursor()
         cur.execute("UPDATE documents SET is_archived = FALSE WHERE documentid = %s;", (document_id,))
+        sync_chunk_filters(cur, document_id)
         conn.commit()
+        cache_versions.bump('corpus')
         return jsonify({"success": True, "message": "Document restored."})
     except Exception as e:
         if conn: conn.rollback()
@@ -1487,10 +4437,15 @@ def restore_document(document_id):
 
 @app.route("/api/news", methods=['GET'])
 def get_all_news():
-    """Gets all news articles, newest first, with pagination."""
+    """Gets all news articles, newest first. Follow `next_cursor` for keyset paging; `page` is still accepted."""
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = request.args.get('per_page', 5, type=int)
-    offset = (page - 1) * per_page
+    try:
+        count_mode = _count_mode()
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     conn = None
     try:
@@ -1498,19 +4453,33 @@ def get_all_news():
         cur = conn.cursor()
         
         # Get total count for pagination
-        cur.execute("SELECT COUNT(*) FROM news_articles;")
-        total_items = cur.fetchone()[0]
-        total_pages = (total_items + per_page - 1) // per_page
+        total_items = count_listing(cur, "FROM news_articles", [], count_mode)
+        total_pages = (total_items + per_page - 1) // per_page if total_items is not None else None
 
         # Get the requested page of articles
-        sql = "SELECT article_id, title, content, publication_date FROM news_articles ORDER BY publication_date DESC LIMIT %s OFFSET %s;"
-        cur.execute(sql, (per_page, offset))
-        articles = [{"article_id": row[0], "title": row[1], "content": row[2], "publication_date": row[3]} for row in cur.fetchall()]
+        where_sql, params, offset = "", [], 0
+        if after:
+            where_sql = "WHERE (publication_date, article_id) < (%s, %s)"
+            params.extend(after)
+        else:
+            offset = (page - 1) * per_page
+        sql = f"""
+            SELECT article_id, title, content, publication_date FROM news_articles
+            {where_sql}
+            ORDER BY publication_date DESC, article_id DESC
+            LIMIT %s OFFSET %s;
+        """
+        cur.execute(sql, params + [per_page + 1, offset])
+        rows = cur.fetchall()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        articles = [{"article_id": row[0], "title": row[1], "content": row[2], "publication_date": row[3]} for row in rows]
         
         return jsonify({
             "articles": articles,
-            "page": page,
-            "total_pages": total_pages
+            "page": None if after else page,
+            "total_pages": total_pages,
+            "next_cursor": encode_cursor(rows[-1][3], rows[-1][0]) if has_more else None
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1536,7 +4505,7 @@ def get_news_article(article_id):
         if conn: conn.close()
 
 @app.route("/api/news", methods=['POST'])
-# @require_role(['Super Administrator', 'IT Administrator']) # Protect this route
+# @require_role('Super Administrator', 'IT Administrator') # Protect this route
 def create_news_article():
     """Creates a new news article. Author is the logged-in admin."""
     author_id = session.get('user_id')
@@ -1566,10 +4535,15 @@ def create_news_article():
 
 @app.route("/api/events", methods=['GET'])
 def get_all_events():
-    """Gets all upcoming events, ordered by date, with pagination."""
+    """Gets all upcoming events, soonest first. Follow `next_cursor` for keyset paging; `page` is still accepted."""
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     per_page = request.args.get('per_page', 3, type=int) # Show 3 events per page
-    offset = (page - 1) * per_page
+    try:
+        count_mode = _count_mode()
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     conn = None
     try:
@@ -1577,25 +4551,34 @@ def get_all_events():
         cur = conn.cursor()
         
         # Get total count of upcoming events
-        cur.execute("SELECT COUNT(*) FROM events WHERE event_date >= CURRENT_TIMESTAMP;")
-        total_items = cur.fetchone()[0]
-        total_pages = (total_items + per_page - 1) // per_page
+        total_items = count_listing(cur, "FROM events WHERE event_date >= CURRENT_TIMESTAMP", [], count_mode)
+        total_pages = (total_items + per_page - 1) // per_page if total_items is not None else None
 
         # Get the requested page of events
-        sql = """
+        keyset_sql, params, offset = "", [], 0
+        if after:
+            keyset_sql = "AND (event_date, event_id) > (%s, %s)"
+            params.extend(after)
+        else:
+            offset = (page - 1) * per_page
+        sql = f"""
             SELECT event_id, title, description, event_date, location 
             FROM events 
-            WHERE event_date >= CURRENT_TIMESTAMP 
-            ORDER BY event_date ASC 
+            WHERE event_date >= CURRENT_TIMESTAMP {keyset_sql}
+            ORDER BY event_date ASC, event_id ASC 
             LIMIT %s OFFSET %s;
         """
-        cur.execute(sql, (per_page, offset))
-        events = [{"event_id": row[0], "title": row[1], "description": row[2], "event_date": row[3], "location": row[4]} for row in cur.fetchall()]
+        cur.execute(sql, params + [per_page + 1, offset])
+        rows = cur.fetchall()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        events = [{"event_id": row[0], "title": row[1], "description": row[2], "event_date": row[3], "location": row[4]} for row in rows]
         
         return jsonify({
             "events": events,
-            "page": page,
-            "total_pages": total_pages
+            "page": None if after else page,
+            "total_pages": total_pages,
+            "next_cursor": encode_cursor(rows[-1][3], rows[-1][0]) if has_more else None
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1621,7 +4604,7 @@ def get_event(event_id):
         if conn: conn.close()
 
 @app.route("/api/events", methods=['POST'])
-# @require_role(['Super Administrator', 'IT Administrator']) # Protect this route
+# @require_role('Super Administrator', 'IT Administrator') # Protect this route
 def create_event():
     """Creates a new event. Creator is the logged-in admin."""
     creator_id = session.get('user_id')
@@ -1648,3 +4631,841 @@ def create_event():
         return jsonify({"error": str(e)}), 500
     finally:
         if conn: conn.close()
+
+# === RUNTIME METRICS ===
+
+@app.route("/api/admin/metrics", methods=['GET'])
+@require_role('IT Administrator')
+def get_runtime_metrics():
+    """Per-worker runtime metrics. Each gunicorn worker reports only its own state."""
+    return jsonify({
+        "db_pool": get_db_pool().stats(),
+        "audit_writer": audit_logger.stats(),
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "search_result_cache": search_result_cache.stats(),
+        "reference_data_cache": reference_cache.stats(),
+        "embedding_provider": active_embedding_provider().stats(),
+        "vector_storage": {"mode": VECTOR_STORAGE, "rerank_factor": rerank_shortlist(VECTOR_STORAGE, 1)}
+    })
+
+# === SCHEMA MIGRATIONS ===
+# Applied in order by `flask --app app migrate` and recorded in schema_migrations.
+# Statements must be idempotent. Migrations marked "transaction": False run in
+# autocommit mode, which CREATE INDEX CONCURRENTLY requires.
+SCHEMA_MIGRATIONS = [
+    {
+        "name": "0001_ingestion_jobs",
+        "statements": [
+            "ALTER TABLE documents ADD COLUMN IF NOT EXISTS status VARCHAR(20) NOT NULL DEFAULT 'ready';",
+            """
+            CREATE TABLE IF NOT EXISTS ingestion_jobs (
+                job_id BIGSERIAL PRIMARY KEY,
+                document_id INTEGER NOT NULL REFERENCES documents(documentid) ON DELETE CASCADE,
+                status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                stage VARCHAR(20),
+                progress JSONB NOT NULL DEFAULT '{}'::jsonb,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                locked_by TEXT,
+                locked_at TIMESTAMPTZ,
+                run_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMPTZ
+            );
+            """,
+            "CREATE INDEX IF NOT EXISTS ingestion_jobs_open_idx ON ingestion_jobs (created_at) WHERE status IN ('pending', 'running');",
+        ],
+    },
+    {
+        "name": "0002_document_chunks_hnsw",
+        "transaction": False,
+        "statements": [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS document_chunks_embedding_hnsw_idx "
+            "ON document_chunks USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);",
+        ],
+    },
+    {
+        "name": "0003_query_embedding_cache",
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS query_embedding_cache (
+                model TEXT NOT NULL,
+                query_hash CHAR(64) NOT NULL,
+                query_text TEXT NOT NULL,
+                embedding vector NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (model, query_hash)
+            );
+            """,
+        ],
+    },
+    {
+        "name": "0004_cache_versions",
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS cache_versions (
+                name TEXT PRIMARY KEY,
+                version BIGINT NOT NULL DEFAULT 0
+            );
+            """,
+        ],
+    },
+    {
+        "name": "0005_full_text_columns",
+        "statements": [
+            """
+            ALTER TABLE faqs ADD COLUMN IF NOT EXISTS search_tsv tsvector GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', coalesce(question, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(answer, '')), 'B')
+            ) STORED;
+            """,
+            """
+            ALTER TABLE documents ADD COLUMN IF NOT EXISTS title_tsv tsvector
+                GENERATED ALWAYS AS (to_tsvector('english', coalesce(title, ''))) STORED;
+            """,
+            """
+            ALTER TABLE document_chunks ADD COLUMN IF NOT EXISTS chunk_tsv tsvector
+                GENERATED ALWAYS AS (to_tsvector('english', coalesce(chunk_text, ''))) STORED;
+            """,
+        ],
+    },
+    {
+        "name": "0006_full_text_indexes",
+        "transaction": False,
+        "statements": [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS faqs_search_tsv_idx ON faqs USING gin (search_tsv);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS documents_title_tsv_idx ON documents USING gin (title_tsv);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS document_chunks_chunk_tsv_idx ON document_chunks USING gin (chunk_tsv);",
+        ],
+    },
+    {
+        # Hybrid retrieval joins the vector and full-text candidate lists on a chunk id;
+        # a no-op where document_chunks already has one
+        "name": "0007_document_chunks_id",
+        "statements": [
+            "ALTER TABLE document_chunks ADD COLUMN IF NOT EXISTS id BIGSERIAL;",
+        ],
+    },
+    {
+        # Copies of the document-level search filters, so they can be pushed into the vector query
+        "name": "0008_document_chunks_filter_columns",
+        "statements": [
+            """
+            ALTER TABLE document_chunks
+                ADD COLUMN IF NOT EXISTS regulator_id INTEGER,
+                ADD COLUMN IF NOT EXISTS type_id INTEGER,
+                ADD COLUMN IF NOT EXISTS is_archived BOOLEAN NOT NULL DEFAULT FALSE,
+                ADD COLUMN IF NOT EXISTS service_ids INTEGER[] NOT NULL DEFAULT '{}';
+            """,
+            """
+            UPDATE document_chunks dc
+            SET regulator_id = d.regulatorid, type_id = d.typeid, is_archived = d.is_archived,
+                service_ids = ARRAY(SELECT serviceid FROM document_services WHERE documentid = d.documentid ORDER BY serviceid)
+            FROM documents d
+            WHERE d.documentid = dc.document_id;
+            """,
+        ],
+    },
+    {
+        "name": "0009_document_chunks_filter_indexes",
+        "transaction": False,
+        "statements": [
+            vector_index_ddl("hnsw"),
+            "DROP INDEX CONCURRENTLY IF EXISTS document_chunks_embedding_hnsw_idx;",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS document_chunks_service_ids_idx ON document_chunks USING gin (service_ids) WHERE NOT is_archived;",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS document_chunks_regulator_idx ON document_chunks (regulator_id) WHERE NOT is_archived;",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS document_chunks_type_idx ON document_chunks (type_id) WHERE NOT is_archived;",
+        ],
+    },
+    {
+        # Composite keys matching the keyset ORDER BYs of the paginated listings
+        "name": "0010_listing_keyset_indexes",
+        "transaction": False,
+        "statements": [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS audit_trail_timestamp_auditid_idx ON audit_trail (timestamp, auditid);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS news_articles_publication_date_id_idx ON news_articles (publication_date, article_id);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS events_event_date_id_idx ON events (event_date, event_id);",
+        ],
+    },
+    {
+        # Swap audit_trail for a monthly range-partitioned table. The legacy
+        # rows are copied across; the serial sequence and foreign keys move
+        # over; the keyset btree from 0010 is rebuilt (per partition) and a
+        # BRIN index covers timestamp range scans at a fraction of the size.
+        "name": "0011_partition_audit_trail",
+        "statements": [
+            """
+            DO $$
+            DECLARE
+                seq TEXT;
+                fk RECORD;
+                low DATE;
+                stop DATE;
+            BEGIN
+                IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'audit_trail'::regclass) THEN
+                    RETURN;
+                END IF;
+                LOCK TABLE audit_trail IN ACCESS EXCLUSIVE MODE;
+                ALTER TABLE audit_trail RENAME TO audit_trail_legacy;
+                UPDATE audit_trail_legacy SET timestamp = NOW() WHERE timestamp IS NULL;
+
+                CREATE TABLE audit_trail (LIKE audit_trail_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp);
+                ALTER TABLE audit_trail ADD CONSTRAINT audit_trail_auditid_timestamp_pkey PRIMARY KEY (auditid, timestamp);
+                seq := pg_get_serial_sequence('audit_trail_legacy', 'auditid');
+                IF seq IS NOT NULL THEN
+                    EXECUTE format('ALTER SEQUENCE %s OWNED BY audit_trail.auditid', seq);
+                END IF;
+                FOR fk IN SELECT conname, pg_get_constraintdef(oid) AS def FROM pg_constraint
+                          WHERE conrelid = 'audit_trail_legacy'::regclass AND contype = 'f' LOOP
+                    EXECUTE format('ALTER TABLE audit_trail ADD CONSTRAINT %I %s', fk.conname || '_p', fk.def);
+                END LOOP;
+
+                SELECT date_trunc('month', COALESCE(MIN(timestamp), NOW()))::date INTO low FROM audit_trail_legacy;
+                stop := (date_trunc('month', NOW()) + INTERVAL '4 months')::date;
+                WHILE low < stop LOOP
+                    EXECUTE format('CREATE TABLE %I PARTITION OF audit_trail FOR VALUES FROM (%L) TO (%L)',
+                                   'audit_trail_' || to_char(low, 'YYYY_MM'), low, (low + INTERVAL '1 month')::date);
+                    low := (low + INTERVAL '1 month')::date;
+                END LOOP;
+                CREATE TABLE audit_trail_default PARTITION OF audit_trail DEFAULT;
+
+                INSERT INTO audit_trail SELECT * FROM audit_trail_legacy;
+                DROP TABLE audit_trail_legacy;
+            END $$;
+            """,
+            "CREATE INDEX IF NOT EXISTS audit_trail_timestamp_auditid_idx ON audit_trail (timestamp, auditid);",
+            "CREATE INDEX IF NOT EXISTS audit_trail_timestamp_brin ON audit_trail USING brin (timestamp);",
+        ],
+    },
+    {
+        # Download validators, filled at upload (older rows on first download)
+        "name": "0012_document_file_fingerprints",
+        "statements": [
+            """
+            ALTER TABLE documents
+                ADD COLUMN IF NOT EXISTS content_sha256 TEXT,
+                ADD COLUMN IF NOT EXISTS file_size BIGINT,
+                ADD COLUMN IF NOT EXISTS file_modified_at TIMESTAMPTZ;
+            """,
+        ],
+    },
+    {
+        # Content-addressed uploads: look up identical files, keep the uploaded name for downloads
+        "name": "0013_document_content_dedup",
+        "statements": [
+            "ALTER TABLE documents ADD COLUMN IF NOT EXISTS original_filename TEXT;",
+            "CREATE INDEX IF NOT EXISTS documents_content_sha256_idx ON documents (content_sha256) WHERE content_sha256 IS NOT NULL;",
+        ],
+    },
+    {
+        # Source pages of each chunk (NULL for chunks ingested before page tracking)
+        "name": "0014_chunk_page_numbers",
+        "statements": [
+            """
+            ALTER TABLE document_chunks
+                ADD COLUMN IF NOT EXISTS page_start INTEGER,
+                ADD COLUMN IF NOT EXISTS page_end INTEGER;
+            """,
+        ],
+    },
+    {
+        # Which model produced each chunk's vector; existing rows came from the configured OpenAI model
+        "name": "0015_chunk_embedding_model",
+        "statements": [
+            """
+            ALTER TABLE document_chunks
+                ADD COLUMN IF NOT EXISTS embedding_model TEXT,
+                ADD COLUMN IF NOT EXISTS embedding_dim INTEGER;
+            """,
+            f"""
+            UPDATE document_chunks
+            SET embedding_model = 'openai:{EMBEDDING_MODEL}', embedding_dim = vector_dims(embedding)
+            WHERE embedding_model IS NULL AND embedding IS NOT NULL;
+            """,
+        ],
+    },
+    {
+        # Model switches: which model document_chunks.embedding holds once a re-embedding
+        # has been cut over (empty until then), and the resumable jobs that get it there
+        "name": "0016_reembedding",
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS embedding_state (
+                singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+                model_id TEXT NOT NULL,
+                dimension INTEGER NOT NULL,
+                switched_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS reembed_jobs (
+                job_id BIGSERIAL PRIMARY KEY,
+                model_id TEXT NOT NULL,
+                previous_model_id TEXT,
+                dimension INTEGER NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'running',
+                phase VARCHAR(20) NOT NULL DEFAULT 'backfill',
+                last_chunk_id BIGINT NOT NULL DEFAULT 0,
+                chunks_done BIGINT NOT NULL DEFAULT 0,
+                chunks_total BIGINT,
+                error TEXT,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMPTZ
+            );
+            """,
+            "CREATE UNIQUE INDEX IF NOT EXISTS reembed_jobs_unfinished_idx ON reembed_jobs ((TRUE)) WHERE finished_at IS NULL;",
+        ],
+    },
+    {
+        # Keyset walks (WHERE id > ... ORDER BY id LIMIT n) and the batched UPDATE ... WHERE id = v.id
+        # of the re-embedding job need this; without it every batch scans the whole table
+        "name": "0017_document_chunks_id_index",
+        "transaction": False,
+        "statements": [
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS document_chunks_id_idx ON document_chunks (id);",
+        ],
+    },
+    {
+        # Record the model an existing corpus was embedded with, so the active model never
+        # comes from whatever ATAS_EMBEDDING_PROVIDER happens to say
+        "name": "0018_seed_embedding_state",
+        "statements": [
+            """
+            INSERT INTO embedding_state (model_id, dimension)
+            SELECT embedding_model, COALESCE(MAX(embedding_dim), MAX(vector_dims(embedding)))
+            FROM document_chunks
+            WHERE embedding_model IS NOT NULL AND embedding IS NOT NULL
+            GROUP BY embedding_model
+            ORDER BY COUNT(*) DESC
+            LIMIT 1
+            ON CONFLICT (singleton) DO NOTHING;
+            """,
+        ],
+    },
+    {
+        # Document listings look up each document's latest ingestion job
+        "name": "0019_ingestion_jobs_document_idx",
+        "statements": [
+            "CREATE INDEX IF NOT EXISTS ingestion_jobs_document_idx ON ingestion_jobs (document_id, job_id DESC);",
+        ],
+    },
+]
+
+def apply_migrations(echo=print):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    name TEXT PRIMARY KEY,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+            """)
+            cur.execute("SELECT name FROM schema_migrations;")
+            applied = {row[0] for row in cur.fetchall()}
+        conn.commit()
+
+        for migration in SCHEMA_MIGRATIONS:
+            if migration["name"] in applied:
+                continue
+            transactional = migration.get("transaction", True)
+            conn.autocommit = not transactional
+            try:
+                with conn.cursor() as cur:
+                    for statement in migration["statements"]:
+                        cur.execute(statement)
+                    cur.execute("INSERT INTO schema_migrations (name) VALUES (%s);", (migration["name"],))
+                if transactional:
+                    conn.commit()
+            except Exception:
+                if transactional:
+                    conn.rollback()
+                raise
+            finally:
+                conn.autocommit = False
+            echo(f"Applied {migration['name']}")
+
+# === CLI COMMANDS ===
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Apply pending schema migrations."""
+    apply_migrations(echo=click.echo)
+
+@app.cli.command("ingest-worker")
+@click.option("--workers", default=INGEST_WORKERS, show_default=True, help="Worker threads to run.")
+def ingest_worker_command(workers):
+    """Run document ingestion workers in the foreground."""
+    ingestion_workers.workers = max(1, workers)
+    ingestion_workers.ensure_started()
+    click.echo(f"Processing ingestion jobs with {ingestion_workers.workers} worker(s). Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        ingestion_workers.stop()
+
+@app.cli.command("build-vector-index")
+@click.option("--method", type=click.Choice(["hnsw", "ivfflat"]), default="hnsw", show_default=True)
+@click.option("--m", default=16, show_default=True, help="HNSW: links per node.")
+@click.option("--ef-construction", default=64, show_default=True, help="HNSW: candidate list size while building.")
+@click.option("--lists", default=0, help="IVFFlat: number of lists (default rows/1000, or sqrt(rows) above 1M rows).")
+@click.option("--storage", type=click.Choice(list(VECTOR_STORAGE_MODES)), default=VECTOR_STORAGE, show_default=True,
+              help="Index representation; search uses the one ATAS_VECTOR_STORAGE names.")
+@click.option("--replace", is_flag=True, help="Drop an existing index of this method first.")
+@click.option("--maintenance-work-mem", default="1GB", show_default=True)
+def build_vector_index_command(method, m, ef_construction, lists, storage, replace, maintenance_work_mem):
+    """Build an ANN index on document_chunks.embedding without blocking writes."""
+    name = vector_index_name(method, storage)
+    with db_connection() as conn:
+        conn.autocommit = True  # CREATE INDEX CONCURRENTLY cannot run in a transaction
+        with conn.cursor() as cur:
+            dim = embedding_column_dimension(cur)
+            if storage != "vector" and dim is None:
+                raise click.ClickException(f"{storage} indexes need a typed column; document_chunks.embedding is untyped.")
+            if method == "ivfflat" and not lists:
+                cur.execute("SELECT COUNT(*) FROM document_chunks;")
+                rows = cur.fetchone()[0]
+                lists = max(1, rows // 1000 if rows <= 1000000 else int(rows ** 0.5))
+            cur.execute("SET maintenance_work_mem = %s;", (maintenance_work_mem,))
+            if replace:
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+            started = time.perf_counter()
+            cur.execute(vector_index_ddl(method, m=m, ef_construction=ef_construction, lists=lists,
+                                         storage=storage, dim=dim))
+            elapsed = time.perf_counter() - started
+            cur.execute("SELECT pg_size_pretty(pg_relation_size(%s::regclass));", (name,))
+            size = cur.fetchone()[0]
+            others = [other for other, _ in vector_indexes_on(cur) if other != name]
+            sizes = {}
+            for other in others:
+                cur.execute("SELECT pg_size_pretty(pg_relation_size(%s::regclass));", (other,))
+                sizes[other] = cur.fetchone()[0]
+        conn.autocommit = False
+    click.echo(f"{name} ready in {elapsed:.1f}s ({size}).")
+    for other in others:
+        click.echo(f"Also on document_chunks.embedding: {other} ({sizes[other]}); "
+                   "drop it once ATAS_VECTOR_STORAGE no longer needs it.")
+
+@app.cli.command("audit-partitions")
+@click.option("--months-ahead", default=AUDIT_PARTITION_MONTHS_AHEAD, show_default=True)
+def audit_partitions_command(months_ahead):
+    """Create upcoming monthly audit_trail partitions."""
+    with db_connection() as conn:
+        created = ensure_audit_partitions(conn, months_ahead)
+    click.echo(f"Created: {', '.join(created)}" if created else "All partitions already exist.")
+
+@app.cli.command("audit-retention")
+@click.option("--keep-months", default=AUDIT_RETENTION_MONTHS, show_default=True, help="Whole months to keep online, besides the current one.")
+@click.option("--archive-dir", default=AUDIT_ARCHIVE_DIR, show_default=True)
+@click.option("--keep-tables", is_flag=True, help="Detach and dump, but leave the detached tables in place.")
+@click.option("--dry-run", is_flag=True)
+def audit_retention_command(keep_months, archive_dir, keep_tables, dry_run):
+    """Archive audit_trail partitions older than the retention window to gzipped CSV."""
+    cutoff = _month_start(datetime.now(timezone.utc).date(), -keep_months)
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            expired = [name for name, month in list_audit_partitions(cur) if month < cutoff]
+        conn.commit()
+        if not expired:
+            click.echo(f"Nothing older than {cutoff:%Y-%m}.")
+            return
+        for name in expired:
+            if dry_run:
+                click.echo(f"Would archive {name}")
+                continue
+            path = archive_audit_partition(conn, name, archive_dir, drop=not keep_tables)
+            click.echo(f"Archived {name} -> {path}")
+
+@app.cli.command("embedding-info")
+def embedding_info_command():
+    """Show the configured embedding provider against what document_chunks holds."""
+    active = active_embedding_provider()
+    click.echo(f"Configured: {embedding_provider.model_id}")
+    click.echo(f"Active: {active.model_id} ({active.dimension} dimensions)")
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            column = embedding_column_dimension(cur)
+            click.echo(f"document_chunks.embedding: {f'vector({column})' if column else 'vector (untyped)'}")
+            cur.execute("""
+                SELECT COALESCE(embedding_model, '(unknown)'), embedding_dim, COUNT(*)
+                FROM document_chunks GROUP BY 1, 2 ORDER BY 3 DESC;
+            """)
+            for model, dim, count in cur.fetchall():
+                marker = "" if model == active.model_id else "  <- not the active model"
+                click.echo(f"  {model:<48} {dim or '?':>5}d {count:>9} chunks{marker}")
+
+@app.cli.command("reembed")
+@click.option("--provider", type=click.Choice(["openai", "local"]), default=None,
+              help="Target provider; omit to resume the unfinished job.")
+@click.option("--model", default=None, help="Target model (defaults to the provider's configured model).")
+@click.option("--batch-size", default=REEMBED_BATCH_SIZE, show_default=True, help="Chunks per checkpointed batch.")
+@click.option("--tpm", default=REEMBED_TOKENS_PER_MINUTE, show_default=True, help="Embedding tokens per minute.")
+@click.option("--rpm", default=REEMBED_REQUESTS_PER_MINUTE, show_default=True, help="OpenAI requests per minute.")
+@click.option("--cutover/--no-cutover", default=True, show_default=True,
+              help="Switch search over once the shadow column and its indexes are ready.")
+@click.option("--maintenance-work-mem", default="1GB", show_default=True)
+def reembed_command(provider, model, batch_size, tpm, rpm, cutover, maintenance_work_mem):
+    """Re-embed document_chunks with another model, resumably, while search keeps serving."""
+    target = create_embedding_provider(provider, model) if provider else None
+    runner = Reembedder(batch_size=batch_size, tokens_per_minute=tpm, requests_per_minute=rpm,
+                        lock_timeout=REEMBED_LOCK_TIMEOUT, echo=click.echo)
+    try:
+        runner.run(target, cutover=cutover, maintenance_work_mem=maintenance_work_mem)
+    except (ValueError, RuntimeError) as e:
+        raise click.ClickException(str(e))
+
+@app.cli.command("reembed-status")
+def reembed_status_command():
+    """Show the unfinished re-embedding job, or the last one."""
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT job_id, previous_model_id, model_id, status, phase, chunks_done, chunks_total,
+                       last_chunk_id, error, created_at, updated_at, finished_at
+                FROM reembed_jobs ORDER BY finished_at IS NULL DESC, job_id DESC LIMIT 1;
+            """)
+            row = cur.fetchone()
+    if row is None:
+        click.echo("No re-embedding jobs.")
+        return
+    (job_id, previous, model, status, phase, done, total, last_id, error, created, updated, finished) = row
+    click.echo(f"Job {job_id}: {previous} -> {model}")
+    click.echo(f"  {status} ({phase}), {done}/{total or '?'} chunks, last id {last_id}")
+    click.echo(f"  started {created:%Y-%m-%d %H:%M}, updated {updated:%Y-%m-%d %H:%M}"
+               + (f", finished {finished:%Y-%m-%d %H:%M}" if finished else ""))
+    if error:
+        click.echo(f"  error: {error}")
+
+@app.cli.command("reembed-cancel")
+def reembed_cancel_command():
+    """Abandon the unfinished re-embedding job and drop its shadow column."""
+    try:
+        job_id = reembedder.cancel()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Cancelled job {job_id}." if job_id else "No unfinished re-embedding job.")
+
+def _synthetic_embeddings(rows, dim, seed=0, clusters=50):
+    """Unit vectors drawn around random cluster centres, which is closer to real embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dim))
+    vectors = centres[rng.integers(0, clusters, size=rows)] + rng.normal(scale=0.6, size=(rows, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+def _exact_top_k(corpus, queries, k):
+    """Ground-truth ids (1-based) by cosine distance, computed in numpy."""
+    scores = queries @ corpus.T
+    return [set((np.argsort(-row)[:k] + 1).tolist()) for row in scores]
+
+def _time_queries(cur, sql, queries, k):
+    latencies, results = [], []
+    for q in queries:
+        started = time.perf_counter()
+        cur.execute(sql, {"q": q, "k": k})
+        rows = cur.fetchall()
+        latencies.append((time.perf_counter() - started) * 1000)
+        results.append({row[0] for row in rows})
+    return latencies, results
+
+def _latency_summary(latencies):
+    return f"p50 {np.percentile(latencies, 50):7.2f} ms  p95 {np.percentile(latencies, 95):7.2f} ms"
+
+@app.cli.command("bench-vector-index")
+@click.option("--rows", default=20000, show_default=True)
+@click.option("--dim", default=1536, show_default=True)
+@click.option("--queries", "query_count", default=50, show_default=True)
+@click.option("--k", default=10, show_default=True)
+@click.option("--method", type=click.Choice(["hnsw", "ivfflat"]), default="hnsw", show_default=True)
+@click.option("--ef-search", default="10,20,40,80,160", show_default=True, help="HNSW values to sweep.")
+@click.option("--probes", default="1,5,10,20", show_default=True, help="IVFFlat values to sweep.")
+def bench_vector_index_command(rows, dim, query_count, k, method, ef_search, probes):
+    """Recall@k vs latency of exact and ANN search on a synthetic corpus (temp table, nothing persisted)."""
+    corpus = _synthetic_embeddings(rows, dim, seed=1)
+    queries = _synthetic_embeddings(query_count, dim, seed=2)
+    truth = _exact_top_k(corpus, queries, k)
+    sql = "SELECT id FROM bench_chunks ORDER BY embedding <=> %(q)s LIMIT %(k)s;"
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"CREATE TEMP TABLE bench_chunks (id INTEGER PRIMARY KEY, embedding vector({dim})) ON COMMIT DROP;")
+            psycopg2.extras.execute_values(cur, "INSERT INTO bench_chunks (id, embedding) VALUES %s;",
+                                           [(i + 1, v) for i, v in enumerate(corpus)], page_size=1000)
+            cur.execute("ANALYZE bench_chunks;")
+
+            latencies, results = _time_queries(cur, sql, queries, k)
+            recall = np.mean([len(got & want) / k for got, want in zip(results, truth)])
+            click.echo(f"exact (seq scan)        recall@{k} {recall:.3f}  {_latency_summary(latencies)}")
+
+            options = "m = 16, ef_construction = 64" if method == "hnsw" else f"lists = {max(1, rows // 1000)}"
+            started = time.perf_counter()
+            cur.execute(f"CREATE INDEX ON bench_chunks USING {method} (embedding vector_cosine_ops) WITH ({options});")
+            click.echo(f"{method} build {time.perf_counter() - started:.2f}s")
+
+            setting = "hnsw.ef_search" if method == "hnsw" else "ivfflat.probes"
+            for value in [int(v) for v in (ef_search if method == "hnsw" else probes).split(",")]:
+                cur.execute(f"SET LOCAL {setting} = %s;", (value,))
+                latencies, results = _time_queries(cur, sql, queries, k)
+                recall = np.mean([len(got & want) / k for got, want in zip(results, truth)])
+                click.echo(f"{setting}={value:<5} recall@{k} {recall:.3f}  {_latency_summary(latencies)}")
+        conn.rollback()
+
+def _storage_bench_sql(storage, dim, table="bench_chunks"):
+    """Top-k query for the storage benchmark, shaped like nearest_chunks_sql()."""
+    if storage == "vector":
+        return f"SELECT id FROM {table} ORDER BY embedding <=> %(q)s LIMIT %(k)s;"
+    operator = VECTOR_STORAGE_MODES[storage][1]
+    approximate = (f"{vector_storage_expression(storage, 'embedding', dim)} {operator} "
+                   f"{vector_storage_expression(storage, '%(q)s::vector', dim)}")
+    return (f"SELECT id FROM (SELECT id, embedding FROM {table} ORDER BY {approximate} LIMIT %(shortlist)s) shortlist "
+            f"ORDER BY embedding <=> %(q)s LIMIT %(k)s;")
+
+@app.cli.command("bench-vector-storage")
+@click.option("--rows", default=20000, show_default=True)
+@click.option("--dim", default=1536, show_default=True)
+@click.option("--queries", "query_count", default=50, show_default=True)
+@click.option("--k", default=10, show_default=True)
+@click.option("--storage", "storages", default="vector,halfvec,binary", show_default=True,
+              help="Storage modes to compare (HNSW, m=16, ef_construction=64).")
+@click.option("--rerank-factor", default=0, help="Shortlist multiple for compact modes (default: per mode).")
+@click.option("--ef-search", default=40, show_default=True, help="Raised to the shortlist size where needed.")
+def bench_vector_storage_command(rows, dim, query_count, k, storages, rerank_factor, ef_search):
+    """Index size, build time, latency and recall@k per vector storage mode (temp table, nothing persisted)."""
+    storages = [storage.strip() for storage in storages.split(",") if storage.strip()]
+    unknown = [storage for storage in storages if storage not in VECTOR_STORAGE_MODES]
+    if unknown:
+        raise click.ClickException(f"Unknown storage mode(s): {', '.join(unknown)}")
+    corpus = _synthetic_embeddings(rows, dim, seed=1)
+    queries = _synthetic_embeddings(query_count, dim, seed=2)
+    truth = _exact_top_k(corpus, queries, k)
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"CREATE TEMP TABLE bench_chunks (id INTEGER PRIMARY KEY, embedding vector({dim})) ON COMMIT DROP;")
+            psycopg2.extras.execute_values(cur, "INSERT INTO bench_chunks (id, embedding) VALUES %s;",
+                                           [(i + 1, v) for i, v in enumerate(corpus)], page_size=1000)
+            cur.execute("ANALYZE bench_chunks;")
+            cur.execute("SELECT pg_total_relation_size('bench_chunks');")
+            click.echo(f"table (float32 vectors, kept for re-ranking) {cur.fetchone()[0] / 2 ** 20:8.1f} MB")
+            click.echo(f"{'storage':<8} {'index MB':>9} {'build s':>8} {'shortlist':>9}  recall@{k}  latency")
+
+            for storage in storages:
+                shortlist = k * (rerank_factor or VECTOR_STORAGE_MODES[storage][2])
+                opclass = VECTOR_STORAGE_MODES[storage][0]
+                started = time.perf_counter()
+                cur.execute(f"CREATE INDEX bench_chunks_{storage}_idx ON bench_chunks USING hnsw "
+                            f"({vector_storage_expression(storage, 'embedding', dim)} {opclass}) "
+                            "WITH (m = 16, ef_construction = 64);")
+                build = time.perf_counter() - started
+                cur.execute(f"SELECT pg_relation_size('bench_chunks_{storage}_idx');")
+                size = cur.fetchone()[0] / 2 ** 20
+                cur.execute("SET LOCAL hnsw.ef_search = %s;", (min(1000, max(ef_search, shortlist)),))
+
+                sql = _storage_bench_sql(storage, dim)
+                latencies, results = [], []
+                for q in queries:
+                    started = time.perf_counter()
+                    cur.execute(sql, {"q": q, "k": k, "shortlist": shortlist})
+                    results.append({row[0] for row in cur.fetchall()})
+                    latencies.append((time.perf_counter() - started) * 1000)
+                recall = np.mean([len(got & want) / k for got, want in zip(results, truth)])
+                click.echo(f"{storage:<8} {size:9.1f} {build:8.2f} {shortlist:9d}  {recall:8.3f}  {_latency_summary(latencies)}")
+                # One index at a time, so each mode's queries can only use its own
+                cur.execute(f"DROP INDEX bench_chunks_{storage}_idx;")
+        conn.rollback()
+
+_SYNTHETIC_WORDS = ("capital", "adequacy", "liquidity", "coverage", "ratio", "licensed", "institution", "shall",
+                    "maintain", "reporting", "requirement", "regulator", "exposure", "limit", "customer", "due",
+                    "diligence", "article", "section", "compliance", "risk", "assessment", "quarterly", "annual")
+
+def _synthetic_pdf(path, pages, words_per_page=450, seed=0):
+    """Write a plain-text PDF (Helvetica, one content stream per page) with pseudo-regulatory wording."""
+    rng = random.Random(seed)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        ("<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{4 + 2 * i} 0 R" for i in range(pages)), pages)).encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i in range(pages):
+        words = [rng.choice(_SYNTHETIC_WORDS) for _ in range(words_per_page)]
+        lines = [" ".join(words[j:j + 12]) for j in range(0, len(words), 12)]
+        content = ("BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({line}) '" for line in lines) + " ET").encode()
+        objects.append(("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                        f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>").encode())
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+    with open(path, "wb") as out:
+        out.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(out.tell())
+            out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+        xref = out.tell()
+        out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            out.write(b"%010d 00000 n \n" % offset)
+        out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+@app.cli.command("bench-pdf-extract")
+@click.option("--pages", default="50,200,500", show_default=True, help="Synthetic document sizes to test.")
+@click.option("--processes", default="1,2,4", show_default=True, help="Pool sizes to compare with in-process extraction.")
+@click.option("--pages-per-task", default=PDF_PAGES_PER_TASK, show_default=True)
+def bench_pdf_extract_command(pages, processes, pages_per_task):
+    """Serial vs process-pool extraction throughput on synthetic PDFs (temp files, nothing persisted)."""
+    with tempfile.TemporaryDirectory() as folder:
+        for page_total in [int(p) for p in pages.split(",")]:
+            path = os.path.join(folder, f"synthetic_{page_total}.pdf")
+            _synthetic_pdf(path, page_total)
+            started = time.perf_counter()
+            characters = sum(len(text) for _, text in iter_pdf_pages(path))
+            serial = time.perf_counter() - started
+            click.echo(f"{page_total:>5} pages  in-process {serial:7.2f}s  ({page_total / serial:6.1f} pages/s, {characters} chars)")
+            for count in [int(p) for p in processes.split(",")]:
+                extractor = PDFExtractor(processes=count, parallel_min_pages=0, pages_per_task=pages_per_task,
+                                         timeout=PDF_EXTRACT_TIMEOUT, start_method=PDF_EXTRACT_START_METHOD)
+                try:
+                    list(extractor.iter_pages(path))  # warm-up: process start-up is paid once per worker
+                    started = time.perf_counter()
+                    extracted = sum(len(text) for _, text in extractor.iter_pages(path))
+                    elapsed = time.perf_counter() - started
+                finally:
+                    extractor.shutdown()
+                click.echo(f"{'':>5}        {count} process(es) {elapsed:7.2f}s  ({page_total / elapsed:6.1f} pages/s, "
+                           f"x{serial / elapsed:4.2f}{'' if extracted == characters else ', text differs'})")
+
+def _synthetic_regulation_pages(pages, words_per_page=450, seed=0):
+    """(page_number, text) stream of sentence-structured regulatory text with an Article heading every few pages."""
+    rng = random.Random(seed)
+    article = 0
+    for number in range(1, pages + 1):
+        sentences = []
+        if number % 3 == 1:
+            article += 1
+            sentences.append(f"Article {article} {rng.choice(_SYNTHETIC_WORDS).capitalize()}.")
+        words = 0
+        while words < words_per_page:
+            length = rng.randint(8, 40)
+            sentence = " ".join(rng.choice(_SYNTHETIC_WORDS) for _ in range(length))
+            sentences.append(sentence.capitalize() + rng.choice([".", ".", ".", ";"]))
+            words += length
+        yield number, " ".join(sentences)
+
+@app.cli.command("bench-chunker")
+@click.option("--pages", default=2000, show_default=True, help="Synthetic pages (~450 words each).")
+@click.option("--max-tokens", default=CHUNK_MAX_TOKENS, show_default=True)
+@click.option("--overlap", default=CHUNK_OVERLAP_TOKENS, show_default=True)
+@click.option("--estimate", is_flag=True, help="Count with estimate_tokens(), as on a host without tiktoken's BPE files.")
+def bench_chunker_command(pages, max_tokens, overlap, estimate):
+    """Throughput (chunks/s) and chunk sizes of the word-window and token-aware chunkers.
+
+    Exits non-zero if the token-aware chunker emits a chunk over --max-tokens.
+    """
+    if estimate:
+        _tokenizer.update(loaded=True, encoding=None)
+    click.echo(f"Tokenizer: {TOKENIZER_ENCODING if get_tokenizer() else 'estimate (tiktoken unavailable)'}")
+    violations = 0
+    chunkers = {
+        "word-window": lambda stream: chunk_pages(stream, max_tokens),
+        "token-aware": TokenChunker(max_tokens=max_tokens, overlap_tokens=overlap,
+                                    min_section_tokens=CHUNK_MIN_SECTION_TOKENS).chunk_pages,
+    }
+    for name, chunker in chunkers.items():
+        started = time.perf_counter()
+        chunks = [chunk for chunk, _, _ in chunker(_synthetic_regulation_pages(pages))]
+        elapsed = time.perf_counter() - started
+        sizes = [count_tokens(chunk) for chunk in chunks]
+        over = sum(1 for size in sizes if size > max_tokens)
+        click.echo(f"{name:<12} {len(sizes):>7} chunks  {len(sizes) / elapsed:9.1f} chunks/s  {pages / elapsed:8.1f} pages/s  "
+                   f"tokens mean {np.mean(sizes):6.1f} max {max(sizes):5d}  over limit {over}")
+        if name == "token-aware":
+            violations = over
+    if violations:
+        raise click.ClickException(f"token-aware chunker emitted {violations} chunk(s) over {max_tokens} tokens")
+
+def _synthetic_extracted_text(megabytes, seed=0):
+    """PDF-like text: ragged line breaks, line-end hyphenation, doubled spaces and ligatures."""
+    rng = random.Random(seed)
+    parts, size = [], 0
+    while size < megabytes * 1024 * 1024:
+        word = rng.choice(_SYNTHETIC_WORDS)
+        roll = rng.random()
+        if roll < 0.03 and len(word) > 5:
+            cut = len(word) // 2
+            piece = f"{word[:cut]}-\n{word[cut:]} "
+        elif roll < 0.10:
+            piece = word + "\n"
+        elif roll < 0.15:
+            piece = word + "  "
+        elif roll < 0.17:
+            piece = word.replace("fi", "\ufb01") + " "
+        else:
+            piece = word + " "
+        parts.append(piece)
+        size += len(piece)
+    return "".join(parts)
+
+@app.cli.command("bench-clean-text")
+@click.option("--megabytes", default=5, show_default=True)
+@click.option("--runs", default=3, show_default=True)
+def bench_clean_text_command(megabytes, runs):
+    """MB/s of the old three-pass clean_text against the document and query normalizer profiles."""
+    def legacy(text):
+        text = re.sub(r'(\w)\s{1,2}(\w)', r'\1\2', text)
+        text = re.sub(r'(\w)-\n(\w)', r'\1\2', text)
+        return re.sub(r'\s+', ' ', text).strip()
+
+    text = _synthetic_extracted_text(megabytes)
+    size = len(text.encode("utf-8")) / (1024 * 1024)
+    candidates = {
+        "legacy 3-pass": legacy,
+        "document": document_normalizer,
+        "document, no dictionary": TextNormalizer("document"),
+        "query": query_normalizer,
+    }
+    click.echo(f"{size:.1f} MB input; dictionary: {'%d words' % len(document_normalizer.dictionary) if document_normalizer.dictionary else 'none'}")
+    for name, normalize in candidates.items():
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            output = normalize(text)
+            timings.append(time.perf_counter() - started)
+        best = min(timings)
+        click.echo(f"{name:<24} {best * 1000:8.1f} ms  {size / best:7.1f} MB/s  {len(output.split()):>9} words out")
+
+@app.cli.command("bench-hybrid-search")
+@click.argument("queries_file", type=click.File())
+@click.option("--k", default=3, show_default=True)
+@click.option("--runs", default=3, show_default=True, help="Timed repetitions per query and mode.")
+def bench_hybrid_search_command(queries_file, k, runs):
+    """Latency and quality of vector-only vs hybrid retrieval on the live corpus.
+
+    QUERIES_FILE has one JSON object per line:
+    {"query": "capital adequacy", "relevant_document_ids": [12, 40]}
+    Queries without relevant ids only contribute to latency.
+    """
+    cases = [json.loads(line) for line in queries_file if line.strip()]
+    results = {mode: {"latencies": [], "recall": [], "reciprocal_rank": []} for mode in SEARCH_MODES}
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            for case in cases:
+                # Embed once per query so only retrieval is timed
+                embedding = get_query_embedding(clean_query(case["query"]))
+                relevant = set(case.get("relevant_document_ids") or [])
+                for mode in SEARCH_MODES:
+                    for _ in range(runs):
+                        started = time.perf_counter()
+                        found = run_smart_search(cur, case["query"], embedding, mode=mode, k=k)
+                        results[mode]["latencies"].append((time.perf_counter() - started) * 1000)
+                    if not relevant:
+                        continue
+                    documents = [r["documentID"] for r in found if r["type"] == "document"]
+                    results[mode]["recall"].append(len(set(documents) & relevant) / len(relevant))
+                    results[mode]["reciprocal_rank"].append(
+                        next((1.0 / (i + 1) for i, doc_id in enumerate(documents) if doc_id in relevant), 0.0))
+        conn.rollback()
+
+    for mode, stats in results.items():
+        line = f"{mode:<7} {_latency_summary(stats['latencies'])}"
+        if stats["recall"]:
+            line += f"  recall@{k} {np.mean(stats['recall']):.3f}  MRR {np.mean(stats['reciprocal_rank']):.3f}"
+        click.echo(line)
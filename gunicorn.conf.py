@@ -0,0 +1,6 @@
+# Gunicorn reads ./gunicorn.conf.py automatically, so the Dockerfile CMD picks this up.
+
+def worker_exit(server, worker):
+    """Flush audit rows still queued in this worker before it exits."""
+    from app import audit_logger
+    audit_logger.shutdown()
@@ -0,0 +1,23 @@
+"""PDF text extraction that runs inside PDFExtractor's worker processes (see app.py).
+
+Kept free of Flask, database and OpenAI imports so spawned workers start fast
+and a PDF that crashes or hangs the parser only takes down a child process.
+"""
+from PyPDF2 import PdfReader
+
+
+def page_count(path):
+    return len(PdfReader(path).pages)
+
+
+def extract_page_range(path, start, stop):
+    """[(page_number, text)] for 1-based pages start..stop-1. A page that fails to extract yields ''."""
+    reader = PdfReader(path)
+    pages = []
+    for number in range(start, stop):
+        try:
+            text = reader.pages[number - 1].extract_text() or ""
+        except Exception:
+            text = ""
+        pages.append((number, text))
+    return pages